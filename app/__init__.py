@@ -8,6 +8,7 @@ from flask_migrate import Migrate
 import os
 from sqlalchemy import MetaData
 import mysql.connector
+from app.db_pool import ConnectionPool
 
 basedir = os.path.abspath(os.path.dirname(__file__))
 
@@ -24,6 +25,88 @@ config = {
 
 app.config['SQLALCHEMY_DATABASE_URI'] = 'mysql+pymysql://{user}:{password}@{host}:{port}/{database}'.format(**config)
 
+# database connections of each worker process: most connections open at once, seconds a request
+# waits for a free one, most requests waiting before further ones fail at once, seconds after which
+# a connection is replaced, and seconds a connection may sit idle before it is pinged on checkout
+app.config['DB_POOL_SIZE'] = 5
+app.config['DB_POOL_TIMEOUT'] = 10
+app.config['DB_POOL_MAX_WAITING'] = 32
+app.config['DB_POOL_RECYCLE'] = 3600
+app.config['DB_POOL_PING_INTERVAL'] = 30
+# the ORM engine uses the same limits
+app.config['SQLALCHEMY_ENGINE_OPTIONS'] = {
+    'pool_size': app.config['DB_POOL_SIZE'],
+    'pool_timeout': app.config['DB_POOL_TIMEOUT'],
+    'pool_recycle': app.config['DB_POOL_RECYCLE'],
+    'pool_pre_ping': True,
+}
+
+# memory budget (bytes) shared by all decoded CT volumes kept in memory
+app.config['DICOM_CACHE_MAX_BYTES'] = 512 * 1024 * 1024
+# seconds a series index is trusted before its folder is checked for changes
+app.config['DICOM_INDEX_CHECK_INTERVAL'] = 2.0
+# series indexes kept in memory per process, the least recently used are read back from disk when needed
+app.config['DICOM_INDEX_MAX_SERIES'] = 1024
+# folder for generated DICOM data (series indexes, rendered slices, ...), kept out of "static"
+app.config['DICOM_CACHE_DIR'] = os.path.join(app.instance_path, 'dicom_cache')
+# size caps (bytes) of the in-memory and on-disk tiers of the rendered slice cache
+app.config['RENDER_CACHE_MEMORY_BYTES'] = 64 * 1024 * 1024
+app.config['RENDER_CACHE_DISK_BYTES'] = 1024 * 1024 * 1024
+# folder of the preprocessed, memory-mapped .npy volumes shared by all worker processes
+app.config['VOLUME_STORE_DIR'] = os.path.join(app.config['DICOM_CACHE_DIR'], 'volumes')
+# per-patient DICOM series ingested from uploads, and the staging area of running uploads
+app.config['DICOM_STORAGE_DIR'] = os.path.join(app.instance_path, 'dicom_studies')
+app.config['DICOM_UPLOAD_DIR'] = os.path.join(app.instance_path, 'dicom_uploads')
+# worker processes parsing DICOM headers during an ingest (None: one per CPU)
+app.config['INGEST_WORKERS'] = None
+# image formats served for full quality images in order of preference (png, webp, jpeg),
+# the first one the client accepts is used, png is always the fallback.
+# See "flask bench-encoders": on the sample series png level 1 encodes fastest of the lossless
+# formats, lossless webp at a higher WEBP_METHOD is smallest but several times slower
+app.config['IMAGE_FORMATS'] = ['png']
+# format of the downsampled previews served while scrolling
+app.config['PREVIEW_FORMAT'] = 'jpeg'
+# encoder settings: zlib level of png (0-9), quality of jpeg (1-95), effort of lossless webp (0-6)
+app.config['PNG_COMPRESS_LEVEL'] = 1
+app.config['JPEG_QUALITY'] = 80
+app.config['WEBP_METHOD'] = 0
+# downsampling factor of "quality=preview" slices served while the slider is dragged
+app.config['PREVIEW_FACTOR'] = 4
+# longest edge in pixels of the series thumbnails shown on the home page
+app.config['THUMBNAIL_SIZE'] = 128
+# intensity projection the series thumbnails are rendered from: mip, minip or mean
+app.config['THUMBNAIL_PROJECTION'] = 'mip'
+# largest number of slices returned by one slice range request
+app.config['MAX_SLICE_RANGE'] = 256
+# largest raw volume (int16 bytes) the viewer downloads whole, larger series are shown from sprite atlases
+app.config['RAW_VOLUME_MAX_BYTES'] = 256 * 1024 * 1024
+# cine playback streams: default and highest frame rate, most passes through the series per stream
+app.config['CINE_FPS'] = 10
+app.config['CINE_MAX_FPS'] = 30
+# lowest frame rate, together with CINE_MAX_LOOPS it bounds how long one stream holds a worker
+app.config['CINE_MIN_FPS'] = 1
+app.config['CINE_MAX_LOOPS'] = 20
+# longest a cine stream runs in wall-clock seconds, however slowly its client reads
+app.config['CINE_MAX_SECONDS'] = 300
+# number of patients per page of the home page list
+app.config['PATIENT_PAGE_SIZE'] = 50
+# patients (with their plans, machine and images) kept by the read-through cache, and seconds
+# an entry is served before it is read again to pick up writes made by other processes
+app.config['PATIENT_CACHE_SIZE'] = 1024
+app.config['PATIENT_CACHE_TTL'] = 30
+# seconds lookup tables (diagnoses, machine names and energies) are served before their version stamp is checked
+app.config['REFERENCE_DATA_TTL'] = 60
+# seconds between rebuilds of the patient search index, which pick up writes made by other processes
+app.config['SEARCH_INDEX_MAX_AGE'] = 300
+# seconds before a failed build of the search index is tried again
+app.config['SEARCH_INDEX_RETRY_INTERVAL'] = 30
+# deflate DICOM exports (about half the size for CT, but CPU bound) instead of storing the files
+app.config['EXPORT_DEFLATE'] = False
+# background rendering of neighbouring slices: threads, slices on each side, queue bound
+app.config['PREFETCH_WORKERS'] = 2
+app.config['PREFETCH_DEPTH'] = 4
+app.config['PREFETCH_MAX_PENDING'] = 16
+
 # a dictionary to define names for various db metadata
 # e.g. primary key (pk), foreign key (fk)
 naming_convention = {
@@ -37,10 +120,10 @@ naming_convention = {
 db = SQLAlchemy(app=app, metadata=MetaData(naming_convention=naming_convention))
 migrate = Migrate(app, db, render_as_batch=True)
 
-# simple connection
-cnx = mysql.connector.connect(**config)
-
-# connection pool is a cache of database connections 
-cnxpool = mysql.connector.pooling.MySQLConnectionPool(pool_name = "mypool", pool_size = 5, **config)
+# connection pool is a cache of database connections. Connections are opened on first use in
+# each process, so importing the app does not connect and forked workers never share sockets
+cnxpool = ConnectionPool(lambda: mysql.connector.connect(**config), app.config['DB_POOL_SIZE'],
+                         app.config['DB_POOL_TIMEOUT'], app.config['DB_POOL_MAX_WAITING'],
+                         app.config['DB_POOL_RECYCLE'], app.config['DB_POOL_PING_INTERVAL'])
 
-from app import routes
\ No newline at end of file
+from app import routes, cli
\ No newline at end of file
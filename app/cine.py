@@ -0,0 +1,40 @@
+# File: cine.py
+#
+# Description: Frame pacing for cine playback streams. Frames are produced by a generator
+#              pipeline that is only advanced when the server has written the previous
+#              frame to the socket, so a slow client throttles rendering instead of
+#              buffering frames; frames that are already late are dropped to keep the
+#              requested frame rate.
+
+import time
+
+
+def cine_frames(start, stop, loops):
+    """Slice indices of `loops` passes through [start, stop)."""
+    for _ in range(loops):
+        yield from range(start, stop)
+
+
+def paced(frames, fps, max_seconds=None, clock=time.monotonic, sleep=time.sleep):
+    """
+    Yield items of frames no faster than fps per second. Items whose display time
+    has already passed when the consumer asks for the next one are skipped, so
+    playback keeps real time instead of drifting behind a slow connection. With
+    max_seconds the stream ends once that much wall-clock time has passed, however
+    slowly the consumer reads.
+    """
+    interval = 1 / fps
+    deadline = clock()
+    end = None if max_seconds is None else deadline + max_seconds
+    for frame in frames:
+        now = clock()
+        if end is not None and now >= end:
+            return
+        if now - deadline >= interval:
+            # more than a whole frame late: drop it and catch up
+            deadline += interval
+            continue
+        if deadline > now:
+            sleep(deadline - now)
+        yield frame
+        deadline += interval
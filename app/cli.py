@@ -0,0 +1,199 @@
+# File: cli.py
+#
+# Description: Maintenance commands registered on the Flask CLI, e.g.
+#              "flask --app run ingest-dicom app/static/dicom"
+
+import tempfile
+import time
+from datetime import date
+
+import click
+
+from app import app, cnxpool
+from PIL import features
+
+from app.encoders import ImageEncoder
+from app.imaging import default_window, render_slice
+from app.ingest import ingest_study
+from app.models import PatientObj, TreatmentPlanObj, TreatmentMachineObj, MedicalImageObj
+from app.routes import series_indexes, volume_cache, volume_store, save_series_images, SAMPLE_DICOM_DIR
+from app.routes import insert_patient, update_patient
+
+
+@app.cli.command("ingest-dicom")
+@click.argument("dicom_dirs", nargs=-1, type=click.Path(exists=True, file_okay=False))
+def ingest_dicom(dicom_dirs):
+    """Preprocess DICOM series folders into memory-mapped .npy volumes."""
+    for dicom_dir in dicom_dirs or (SAMPLE_DICOM_DIR,):
+        start = time.perf_counter()
+        index = series_indexes.get(dicom_dir)
+        index.refresh(force=True)
+        volume = volume_store.ingest(index)
+        elapsed = time.perf_counter() - start
+        click.echo(f"{dicom_dir}: {volume.shape[0]} slices of {volume.shape[1]}x{volume.shape[2]} in {elapsed:.2f}s")
+
+
+@app.cli.command("ingest-study")
+@click.argument("patient_id", type=int)
+@click.argument("source", type=click.Path(exists=True))
+def ingest_study_command(patient_id, source):
+    """Ingest a folder or zip of DICOM files into a patient's series storage."""
+    start = time.perf_counter()
+    with tempfile.TemporaryDirectory() as staging_dir:
+        # files of a source folder are copied, the folder is left untouched
+        summaries = ingest_study(source, patient_id, app.config["DICOM_STORAGE_DIR"], staging_dir,
+                                 series_indexes, volume_store, app.config["INGEST_WORKERS"], move=False)
+    save_series_images(patient_id, summaries)
+    for summary in summaries:
+        click.echo(f"{summary['series_uid']}: {summary['num_slices']} slices ({summary['modality']})")
+    click.echo(f"{len(summaries)} series in {time.perf_counter() - start:.2f}s")
+
+
+@app.cli.command("bench-encoders")
+@click.option("--slices", default=20, help="Number of slices of the sample series to encode.")
+def bench_encoders(slices):
+    """Report encode time and size per image format on the bundled sample series."""
+    index = series_indexes.get(SAMPLE_DICOM_DIR)
+    entries = index.get_slices()
+    volume = volume_cache.get_volume(index)
+    step = max(len(entries) // slices, 1)
+    images = []
+    for i in range(0, len(entries), step)[:slices]:
+        center, width = default_window(entries[i], volume[i])
+        images.append(render_slice(volume[i], center, width))
+
+    candidates = [ImageEncoder("png", "image/png", "PNG", compress_level=level) for level in (0, 1, 6, 9)]
+    if features.check("webp"):
+        candidates += [ImageEncoder("webp", "image/webp", "WEBP", lossless=True, method=method) for method in (0, 4)]
+    candidates += [ImageEncoder("jpeg", "image/jpeg", "JPEG", quality=quality) for quality in (80, 90)]
+
+    click.echo(f"{len(images)} slices of {images[0].size[0]}x{images[0].size[1]}")
+    click.echo(f"{'format':<8}{'settings':<28}{'ms/image':>10}{'KiB/image':>11}")
+    for encoder in candidates:
+        start = time.perf_counter()
+        total_bytes = sum(len(encoder.encode(image)) for image in images)
+        elapsed = (time.perf_counter() - start) / len(images)
+        settings = ", ".join(f"{key}={value}" for key, value in encoder.options.items())
+        click.echo(f"{encoder.name:<8}{settings:<28}{elapsed * 1000:>10.2f}{total_bytes / len(images) / 1024:>11.1f}")
+
+
+def legacy_insert_patient(connection, name, date_of_birth, diagnosis, plans, images, machine):
+    """The former create_patient writes: the patient is committed first, then one INSERT per row."""
+    cursor = connection.cursor()
+    cursor.execute("INSERT INTO Patient (name, date_of_birth, diagnosis) VALUES (%s, %s, %s)",
+                   (name, date_of_birth, diagnosis))
+    connection.commit()
+    patient_id = cursor.lastrowid
+    for plan in plans:
+        cursor.execute("INSERT INTO TreatmentPlan (patient_id, name, dose, fractionation) VALUES (%s, %s, %s, %s)",
+                       (patient_id, *plan))
+    for image in images:
+        cursor.execute("INSERT INTO MedicalImage (patient_id, type, date_acquired) VALUES (%s, %s, %s)",
+                       (patient_id, *image))
+    cursor.execute("INSERT INTO TreatmentMachine (patient_id, name, energy) VALUES (%s, %s, %s)", (patient_id, *machine))
+    connection.commit()
+    cursor.close()
+    return patient_id
+
+
+def legacy_update_patient(connection, patient, existing_plans, existing_images, name, date_of_birth, diagnosis, plans,
+                          images, machine):
+    """The former edit_patient writes: every row is rewritten and committed on its own."""
+    cursor = connection.cursor()
+    cursor.execute("UPDATE Patient SET name = %s, date_of_birth = %s, diagnosis = %s WHERE id = %s",
+                   (name, date_of_birth, diagnosis, patient.id))
+    connection.commit()
+    for plan, values in zip(existing_plans, plans):
+        cursor.execute("UPDATE TreatmentPlan SET name = %s, dose = %s, fractionation = %s WHERE id = %s",
+                       (*values, plan.id))
+        connection.commit()
+    for values in plans[len(existing_plans):]:
+        cursor.execute("INSERT INTO TreatmentPlan (patient_id, name, dose, fractionation) VALUES (%s, %s, %s, %s)",
+                       (patient.id, *values))
+        connection.commit()
+    cursor.execute("UPDATE TreatmentMachine SET name = %s, energy = %s WHERE patient_id = %s", (*machine, patient.id))
+    connection.commit()
+    for image, values in zip(existing_images, images):
+        cursor.execute("UPDATE MedicalImage SET type = %s, date_acquired = %s WHERE id = %s", (*values, image.id))
+        connection.commit()
+    for values in images[len(existing_images):]:
+        cursor.execute("INSERT INTO MedicalImage (patient_id, type, date_acquired) VALUES (%s, %s, %s)",
+                       (patient.id, *values))
+        connection.commit()
+    cursor.close()
+
+
+def load_patient_rows(connection, patient_id):
+    """Patient, plans, images and machine as the edit page loads them."""
+    cursor = connection.cursor(dictionary=True)
+    cursor.execute("SELECT * FROM Patient WHERE id = %s", (patient_id,))
+    patient = PatientObj(**cursor.fetchone())
+    cursor.execute("SELECT * FROM TreatmentPlan WHERE patient_id = %s ORDER BY id", (patient_id,))
+    plans = [TreatmentPlanObj(**row) for row in cursor.fetchall()]
+    cursor.execute("SELECT * FROM MedicalImage WHERE patient_id = %s ORDER BY id", (patient_id,))
+    images = [MedicalImageObj(**row) for row in cursor.fetchall()]
+    cursor.execute("SELECT * FROM TreatmentMachine WHERE patient_id = %s", (patient_id,))
+    machine = TreatmentMachineObj(**cursor.fetchone())
+    cursor.close()
+    return patient, plans, images, machine
+
+
+@app.cli.command("bench-patient-writes")
+@click.option("--patients", default=20, help="Number of patients created and edited per strategy.")
+@click.option("--rows", default=5, help="Treatment plans and medical images per patient.")
+def bench_patient_writes(patients, rows):
+    """
+    Compare the per-row commits of the former create/edit handlers with the
+    single-transaction batched writes, against the configured MySQL database.
+    The benchmark patients are deleted afterwards.
+    """
+    plans = [(f"Plan {i}", 60.0, 2.0) for i in range(rows)]
+    images = [("CT", date(2024, 1, i + 1)) for i in range(rows)]
+    machine = ("Linac", "6 MV")
+    # a typical edit: one plan and one image changed, one plan added
+    edited_plans = [("Plan 0 boost", 66.0, 2.0)] + plans[1:] + [("Plan extra", 10.0, 5.0)]
+    edited_images = images[:-1] + [("MR", images[-1][1])]
+
+    strategies = {
+        "per-row commits": (
+            legacy_insert_patient,
+            lambda connection, patient, old_plans, old_images, old_machine: legacy_update_patient(
+                connection, patient, old_plans, old_images, patient.name, patient.date_of_birth, patient.diagnosis,
+                edited_plans, edited_images, machine)),
+        "one transaction": (
+            insert_patient,
+            lambda connection, patient, old_plans, old_images, old_machine: update_patient(
+                connection, patient, old_plans, old_images, old_machine, patient.name, patient.date_of_birth,
+                patient.diagnosis, edited_plans, edited_images, machine)),
+    }
+
+    connection = cnxpool.get_connection()
+    created = []
+    try:
+        click.echo(f"{patients} patients with {rows} plans and {rows} images each")
+        click.echo(f"{'strategy':<18}{'create ms':>11}{'edit ms':>10}")
+        for label, (insert, update) in strategies.items():
+            create_time = edit_time = 0.0
+            for i in range(patients):
+                start = time.perf_counter()
+                patient_id = insert(connection, f"Benchmark {label} {i}", date(1970, 1, 1), "Benchmark",
+                                    plans, images, machine)
+                create_time += time.perf_counter() - start
+                created.append(patient_id)
+
+                # loading the rows is common to both strategies and not timed
+                patient, old_plans, old_images, old_machine = load_patient_rows(connection, patient_id)
+                start = time.perf_counter()
+                update(connection, patient, old_plans, old_images, old_machine)
+                edit_time += time.perf_counter() - start
+            click.echo(f"{label:<18}{create_time / patients * 1000:>11.2f}{edit_time / patients * 1000:>10.2f}")
+    finally:
+        if created:
+            cursor = connection.cursor()
+            values = [(patient_id,) for patient_id in created]
+            for table in ("TreatmentPlan", "MedicalImage", "TreatmentMachine"):
+                cursor.executemany(f"DELETE FROM {table} WHERE patient_id = %s", values)
+            cursor.executemany("DELETE FROM Patient WHERE id = %s", values)
+            connection.commit()
+            cursor.close()
+        connection.close()
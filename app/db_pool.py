@@ -0,0 +1,221 @@
+# File: db_pool.py
+#
+# Description: Process-local pool of MySQL connections. Nothing is opened at import: connections
+#              are created on first checkout, up to the pool size, so a Gunicorn master that
+#              imports the app with --preload never hands sockets to its workers, and a forked
+#              child starts with an empty pool. A checkout blocks until a connection is free,
+#              with a bounded number of waiters and a wait timeout; connections idle for a
+#              while are pinged before use and connections past their age limit are replaced.
+#              Checkout waits are counted so pool pressure shows up before requests time out,
+#              and optional hooks receive every checkout wait and statement time.
+
+import os
+import threading
+import time
+import weakref
+
+from mysql.connector.errors import Error, PoolError
+
+
+class PoolTimeout(PoolError):
+    """No connection became free in time, or too many requests were already waiting."""
+
+
+class PooledConnection:
+    """
+    A checked out connection. Behaves like the underlying connection; close()
+    returns it to the pool instead of closing it, like mysql.connector's
+    PooledMySQLConnection.
+    """
+
+    def __init__(self, pool, connection, created_at, wait):
+        self._pool = pool
+        self._connection = connection
+        self._created_at = created_at
+        # seconds the checkout waited for a free connection
+        self.wait = wait
+
+    def __getattr__(self, name):
+        return getattr(self._connection, name)
+
+    def cursor(self, *args, **kwargs):
+        cursor = self._connection.cursor(*args, **kwargs)
+        if self._pool.on_query is None:
+            return cursor
+        return TimedCursor(cursor, self._pool.on_query)
+
+    def close(self):
+        if self._connection is not None:
+            connection, self._connection = self._connection, None
+            self._pool._release(connection, self._created_at)
+
+
+class TimedCursor:
+    """Cursor passing the duration of every execute() and executemany() to on_query(seconds)."""
+
+    def __init__(self, cursor, on_query):
+        self._cursor = cursor
+        self._on_query = on_query
+
+    def __getattr__(self, name):
+        return getattr(self._cursor, name)
+
+    def __iter__(self):
+        return iter(self._cursor)
+
+    def execute(self, *args, **kwargs):
+        start = time.perf_counter()
+        try:
+            return self._cursor.execute(*args, **kwargs)
+        finally:
+            self._on_query(time.perf_counter() - start)
+
+    def executemany(self, *args, **kwargs):
+        start = time.perf_counter()
+        try:
+            return self._cursor.executemany(*args, **kwargs)
+        finally:
+            self._on_query(time.perf_counter() - start)
+
+
+class ConnectionPool:
+    """
+    At most size connections opened by connect(). get_connection() waits up to
+    timeout seconds for a free one, and fails at once when max_waiting callers
+    are already waiting. Idle connections unused for ping_interval seconds are
+    checked with a ping before being handed out; connections older than recycle
+    seconds are closed and replaced. on_checkout(wait_seconds) and
+    on_query(seconds), when set, are called for every checkout and statement.
+    """
+
+    on_checkout = None
+    on_query = None
+
+    def __init__(self, connect, size, timeout, max_waiting, recycle, ping_interval):
+        self.connect = connect
+        self.size = size
+        self.timeout = timeout
+        self.max_waiting = max_waiting
+        self.recycle = recycle
+        self.ping_interval = ping_interval
+        self._reset()
+        # a child process must not use the connections (and the lock) it inherited
+        pool = weakref.ref(self)
+        os.register_at_fork(after_in_child=lambda: pool() and pool()._reset())
+
+    def _reset(self):
+        # connections inherited from the parent process are kept referenced but never used or
+        # closed, closing them would end the parent's sessions on the shared sockets
+        self._inherited = getattr(self, "_inherited", []) + [entry[0] for entry in getattr(self, "_idle", [])]
+        # idle connections as (connection, created_at, released_at), most recently used last
+        self._idle = []
+        self._checked_out = 0
+        self._waiting = 0
+        self._available = threading.Condition(threading.Lock())
+        # checkout counters since the process started
+        self._checkouts = 0
+        self._timeouts = 0
+        self._waited = 0
+        self._wait_seconds = 0.0
+        self._wait_max = 0.0
+
+    def stats(self):
+        """
+        Pool state and checkout counters of this process: checkouts, checkouts
+        that had to wait, total and longest wait in seconds, and timeouts.
+        """
+        with self._available:
+            return {
+                "size": self.size,
+                "checked_out": self._checked_out,
+                "idle": len(self._idle),
+                "waiting": self._waiting,
+                "checkouts": self._checkouts,
+                "waited": self._waited,
+                "wait_seconds": self._wait_seconds,
+                "wait_max_seconds": self._wait_max,
+                "timeouts": self._timeouts,
+            }
+
+    def get_connection(self):
+        start = time.monotonic()
+        deadline = start + self.timeout
+        blocked = False
+        with self._available:
+            while not self._idle and self._checked_out >= self.size:
+                if self._waiting >= self.max_waiting:
+                    self._timeouts += 1
+                    raise PoolTimeout(f"{self._waiting} requests already waiting for a database connection")
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    self._timeouts += 1
+                    raise PoolTimeout(f"no database connection free after {self.timeout} s")
+                self._waiting += 1
+                blocked = True
+                try:
+                    self._available.wait(remaining)
+                finally:
+                    self._waiting -= 1
+
+            if self._idle:
+                connection, created_at, released_at = self._idle.pop()
+            else:
+                connection, created_at, released_at = None, None, None
+            # the slot is taken from here on, the connection is checked or opened outside the lock
+            self._checked_out += 1
+            wait = time.monotonic() - start
+            self._checkouts += 1
+            if blocked:
+                self._waited += 1
+            self._wait_seconds += wait
+            self._wait_max = max(self._wait_max, wait)
+
+        try:
+            now = time.monotonic()
+            if connection is not None and not self._healthy(connection, created_at, released_at, now):
+                self._discard(connection)
+                connection = None
+            if connection is None:
+                connection, created_at = self.connect(), now
+        except BaseException:
+            self._free_slot()
+            raise
+        if self.on_checkout is not None:
+            self.on_checkout(wait)
+        return PooledConnection(self, connection, created_at, wait)
+
+    def _healthy(self, connection, created_at, released_at, now):
+        if now - created_at > self.recycle:
+            return False
+        if now - released_at > self.ping_interval:
+            try:
+                connection.ping(reconnect=False)
+            except Error:
+                return False
+        return True
+
+    def _release(self, connection, created_at):
+        try:
+            # an open transaction must not leak into the next request
+            if connection.in_transaction:
+                connection.rollback()
+        except Error:
+            self._discard(connection)
+            self._free_slot()
+            return
+        with self._available:
+            self._checked_out -= 1
+            self._idle.append((connection, created_at, time.monotonic()))
+            self._available.notify()
+
+    def _free_slot(self):
+        with self._available:
+            self._checked_out -= 1
+            self._available.notify()
+
+    @staticmethod
+    def _discard(connection):
+        try:
+            connection.close()
+        except Error:
+            pass
@@ -0,0 +1,145 @@
+# File: dicom_cache.py
+#
+# Description: In-memory cache of decoded CT volumes. The first request for a series
+#              decodes and rescales every slice into one contiguous int16 3D array; later slice
+#              requests are served straight from that array. Volumes are evicted in
+#              least-recently-used order once the configured memory budget is exceeded,
+#              and a series is re-decoded when its series index reports a change.
+
+import os
+import threading
+import time
+from collections import OrderedDict
+
+import numpy as np
+import pydicom
+
+from app.imaging import rescale_slice
+from app.metrics import dicom_stage_seconds
+
+
+class CachedVolume:
+    def __init__(self, volume, version):
+        self.volume = volume
+        self.version = version
+
+    @property
+    def nbytes(self):
+        return self.volume.nbytes
+
+
+class VolumeCache:
+    """
+    LRU cache of decoded series keyed by the folder holding the .dcm files.
+
+    max_bytes is the memory budget shared by every cached volume. Slice order and
+    change detection come from the series index, a cached volume is dropped as
+    soon as the index version of its series changes. With a volume store, volumes
+    are memory-mapped from their preprocessed .npy file instead of being decoded
+    into private memory.
+    """
+
+    def __init__(self, max_bytes, store=None):
+        self.max_bytes = max_bytes
+        self.store = store
+        self._volumes = OrderedDict()
+        self._lock = threading.Lock()
+        # one lock per series so concurrent first requests decode a series only once
+        self._load_locks = {}
+
+    @property
+    def nbytes(self):
+        with self._lock:
+            return sum(entry.nbytes for entry in self._volumes.values())
+
+    def get_slice(self, index, slice_index):
+        volume = self.get_volume(index)
+        if slice_index < 0 or slice_index >= volume.shape[0]:
+            raise IndexError(f"slice {slice_index} out of range for {volume.shape[0]} slices")
+        return volume[slice_index]
+
+    def get_volume(self, index):
+        version, slices = index.snapshot()
+        entry = self._lookup(index.dicom_dir, version)
+        if entry is not None:
+            return entry.volume
+
+        with self._load_lock(index.dicom_dir):
+            # another thread may have finished decoding while we waited
+            entry = self._lookup(index.dicom_dir, version)
+            if entry is not None:
+                return entry.volume
+
+            if self.store is not None:
+                volume = self.store.load(index, version)
+                if volume is None:
+                    # first request since the series changed, persist it for every worker
+                    self.store.save(index, version, slices, decode_volume(index.dicom_dir, slices))
+                    volume = self.store.load(index, version)
+            else:
+                volume = decode_volume(index.dicom_dir, slices)
+            self._store(index.dicom_dir, CachedVolume(volume, version))
+            return volume
+
+    def invalidate(self, dicom_dir=None):
+        with self._lock:
+            if dicom_dir is None:
+                self._volumes.clear()
+            else:
+                self._volumes.pop(dicom_dir, None)
+
+    def _lookup(self, dicom_dir, version):
+        with self._lock:
+            entry = self._volumes.get(dicom_dir)
+            if entry is None:
+                return None
+            if entry.version != version:
+                del self._volumes[dicom_dir]
+                return None
+            self._volumes.move_to_end(dicom_dir)
+            return entry
+
+    def _store(self, dicom_dir, entry):
+        # a single series larger than the whole budget is served but never cached
+        if entry.nbytes > self.max_bytes:
+            return
+
+        with self._lock:
+            self._volumes[dicom_dir] = entry
+            self._volumes.move_to_end(dicom_dir)
+            total = sum(cached.nbytes for cached in self._volumes.values())
+            while total > self.max_bytes:
+                _, evicted = self._volumes.popitem(last=False)
+                total -= evicted.nbytes
+
+    def _load_lock(self, dicom_dir):
+        with self._lock:
+            return self._load_locks.setdefault(dicom_dir, threading.Lock())
+
+
+def decode_volume(dicom_dir, slices):
+    """
+    Decode every slice of the index into one contiguous (slices, rows, columns)
+    int16 array of rescaled values (Hounsfield units for CT). The time spent
+    parsing files and decoding pixel data is recorded per volume.
+    """
+    volume = None
+    read_seconds = decode_seconds = 0.0
+    for i, entry in enumerate(slices):
+        start = time.perf_counter()
+        ds = pydicom.dcmread(os.path.join(dicom_dir, entry["filename"]))
+        parsed = time.perf_counter()
+        pixels = ds.pixel_array
+        read_seconds += parsed - start
+        decode_seconds += time.perf_counter() - parsed
+        if volume is None:
+            volume = np.empty((len(slices),) + pixels.shape, dtype=np.int16)
+        elif pixels.shape != volume.shape[1:]:
+            raise ValueError(f"{entry['filename']} has shape {pixels.shape}, expected {volume.shape[1:]}")
+        volume[i] = rescale_slice(pixels, entry["rescale_slope"], entry["rescale_intercept"])
+
+    if volume is None:
+        raise FileNotFoundError(f"no DICOM files in {dicom_dir}")
+    dicom_stage_seconds.observe(read_seconds, "read")
+    dicom_stage_seconds.observe(decode_seconds, "decode")
+    return volume
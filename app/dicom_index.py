@@ -0,0 +1,236 @@
+# File: dicom_index.py
+#
+# Description: Persistent, header-only index of a DICOM series folder. Every file is
+#              read once with stop_before_pixels and the geometry needed to order and
+#              rescale the slices is kept in a JSON file next to the other caches.
+#              Routes read slice counts and slice order from the index instead of
+#              listing and sorting the folder on every request.
+
+import hashlib
+import json
+import os
+import tempfile
+import threading
+import time
+from collections import OrderedDict
+
+import numpy as np
+import pydicom
+from pydicom.multival import MultiValue
+
+# bump when the layout of the stored slice entries changes
+INDEX_FORMAT = 2
+
+
+def read_slice_header(path):
+    """Read the header of one .dcm file and return the fields the index keeps."""
+    with open(path, "rb") as f:
+        ds = pydicom.dcmread(f, stop_before_pixels=True)
+        # dcmread stops right at the (7FE0,0010) Pixel Data element
+        pixel_data_offset = f.tell()
+    return slice_header(ds, pixel_data_offset, os.stat(path))
+
+
+def slice_header(ds, pixel_data_offset, stat):
+    """Index fields of a dataset read without its pixel data."""
+    position = ds.get("ImagePositionPatient")
+    orientation = ds.get("ImageOrientationPatient")
+    spacing = ds.get("PixelSpacing")
+    window_center = ds.get("WindowCenter")
+    window_width = ds.get("WindowWidth")
+    return {
+        "mtime_ns": stat.st_mtime_ns,
+        "size": stat.st_size,
+        "series_uid": str(ds.get("SeriesInstanceUID", "")),
+        "instance_number": int(ds.InstanceNumber) if ds.get("InstanceNumber") is not None else None,
+        "position": [float(v) for v in position] if position else None,
+        "orientation": [float(v) for v in orientation] if orientation else None,
+        "pixel_spacing": [float(v) for v in spacing] if spacing else None,
+        "slice_thickness": float(ds.SliceThickness) if ds.get("SliceThickness") is not None else None,
+        "rescale_slope": float(ds.get("RescaleSlope", 1) or 1),
+        "rescale_intercept": float(ds.get("RescaleIntercept", 0) or 0),
+        "window_center": first_value(window_center),
+        "window_width": first_value(window_width),
+        "rows": int(ds.get("Rows", 0)),
+        "columns": int(ds.get("Columns", 0)),
+        "pixel_data_offset": pixel_data_offset,
+    }
+
+
+def first_value(value):
+    """WindowCenter/WindowWidth may hold several values, the first one is the default."""
+    if value is None:
+        return None
+    if isinstance(value, MultiValue):
+        value = value[0] if len(value) else None
+    return float(value) if value is not None else None
+
+
+def slice_sort_key(entry):
+    """
+    Order slices along the patient axis: project ImagePositionPatient on the slice
+    normal, fall back to InstanceNumber and finally to the filename.
+    """
+    if entry["position"] and entry["orientation"]:
+        row_cosines = np.array(entry["orientation"][:3])
+        column_cosines = np.array(entry["orientation"][3:])
+        normal = np.cross(row_cosines, column_cosines)
+        return (0, float(np.dot(normal, entry["position"])), entry["filename"])
+    if entry["instance_number"] is not None:
+        return (1, entry["instance_number"], entry["filename"])
+    return (2, 0, entry["filename"])
+
+
+def series_geometry(slices):
+    """
+    Voxel geometry of an ordered series: in-plane pixel spacing (row, column), the
+    distance between slice centres along the normal and the nominal slice thickness.
+    """
+    first = slices[0]
+    pixel_spacing = first["pixel_spacing"] or [1.0, 1.0]
+    slice_spacing = None
+    if len(slices) > 1 and all(entry["position"] and entry["orientation"] for entry in slices):
+        normal = np.cross(first["orientation"][:3], first["orientation"][3:])
+        offsets = np.array([entry["position"] for entry in slices]) @ normal
+        slice_spacing = float(np.median(np.abs(np.diff(offsets))))
+    if not slice_spacing:
+        slice_spacing = first["slice_thickness"] or 1.0
+    return {
+        "pixel_spacing": pixel_spacing,
+        "slice_spacing": slice_spacing,
+        "slice_thickness": first["slice_thickness"],
+        "rows": first["rows"],
+        "columns": first["columns"],
+    }
+
+
+class SeriesIndex:
+    """
+    Header index of the .dcm files in one folder.
+
+    The folder is re-scanned at most every check_interval seconds; only files
+    whose size or modification time changed are read again.
+    """
+
+    def __init__(self, dicom_dir, index_path, check_interval=2.0):
+        self.dicom_dir = dicom_dir
+        self.index_path = index_path
+        self.check_interval = check_interval
+        self.version = ""
+        self.slices = []
+        self._entries = {}
+        self._checked_at = None
+        self._lock = threading.Lock()
+        self._load()
+
+    @property
+    def num_slices(self):
+        self.refresh()
+        return len(self.slices)
+
+    def get_slices(self):
+        self.refresh()
+        return self.slices
+
+    def snapshot(self):
+        """Return (version, slices) as one consistent pair."""
+        self.refresh()
+        with self._lock:
+            return self.version, self.slices
+
+    def seed(self, entries):
+        """Add already parsed slice headers (e.g. from the ingest pipeline) without re-reading the files."""
+        with self._lock:
+            for entry in entries:
+                self._entries[entry["filename"]] = entry
+            self._rebuild()
+            self._save()
+
+    def refresh(self, force=False):
+        """Re-scan the folder if the last scan is older than check_interval."""
+        with self._lock:
+            now = time.monotonic()
+            if not force and self._checked_at is not None and now - self._checked_at < self.check_interval:
+                return
+            self._checked_at = now
+
+            changed = False
+            seen = set()
+            with os.scandir(self.dicom_dir) as files:
+                for file in files:
+                    if not file.name.endswith(".dcm"):
+                        continue
+                    seen.add(file.name)
+                    stat = file.stat()
+                    entry = self._entries.get(file.name)
+                    if entry and entry["mtime_ns"] == stat.st_mtime_ns and entry["size"] == stat.st_size:
+                        continue
+                    entry = read_slice_header(file.path)
+                    entry["filename"] = file.name
+                    self._entries[file.name] = entry
+                    changed = True
+
+            for filename in set(self._entries) - seen:
+                del self._entries[filename]
+                changed = True
+
+            if changed or not self.version:
+                self._rebuild()
+                self._save()
+
+    def _rebuild(self):
+        self.slices = sorted(self._entries.values(), key=slice_sort_key)
+        digest = hashlib.sha1()
+        for entry in self.slices:
+            digest.update(f"{entry['filename']}:{entry['mtime_ns']}:{entry['size']};".encode())
+        self.version = digest.hexdigest()[:16]
+
+    def _load(self):
+        try:
+            with open(self.index_path) as f:
+                stored = json.load(f)
+        except (OSError, ValueError):
+            return
+        if stored.get("format") != INDEX_FORMAT or stored.get("dicom_dir") != self.dicom_dir:
+            return
+        self._entries = {entry["filename"]: entry for entry in stored["slices"]}
+        self._rebuild()
+
+    def _save(self):
+        stored = {"format": INDEX_FORMAT, "dicom_dir": self.dicom_dir, "version": self.version, "slices": self.slices}
+        directory = os.path.dirname(self.index_path)
+        os.makedirs(directory, exist_ok=True)
+        # write to a temporary file and rename so readers never see a partial index
+        fd, tmp_path = tempfile.mkstemp(dir=directory, suffix=".tmp")
+        with os.fdopen(fd, "w") as f:
+            json.dump(stored, f)
+        os.replace(tmp_path, self.index_path)
+
+
+class SeriesIndexRegistry:
+    """
+    One SeriesIndex per series folder, persisted under index_dir. At most
+    max_indexes are kept in memory, the least recently used is dropped and read
+    back from its file when its folder is asked for again.
+    """
+
+    def __init__(self, index_dir, check_interval=2.0, max_indexes=1024):
+        self.index_dir = index_dir
+        self.check_interval = check_interval
+        self.max_indexes = max_indexes
+        self._indexes = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, dicom_dir):
+        dicom_dir = os.path.abspath(dicom_dir)
+        with self._lock:
+            index = self._indexes.get(dicom_dir)
+            if index is None:
+                name = hashlib.sha1(dicom_dir.encode()).hexdigest()[:16] + ".json"
+                index = SeriesIndex(dicom_dir, os.path.join(self.index_dir, name), self.check_interval)
+                self._indexes[dicom_dir] = index
+                while len(self._indexes) > self.max_indexes:
+                    self._indexes.popitem(last=False)
+            else:
+                self._indexes.move_to_end(dicom_dir)
+        return index
@@ -0,0 +1,74 @@
+# File: encoders.py
+#
+# Description: Image encoders for rendered slices and format negotiation. Lossless WebP,
+#              PNG with a tuned compress_level and JPEG for previews are available; the
+#              format of a response is picked from the "format" query parameter, the
+#              client's Accept header and the formats enabled for the deployment.
+
+import io
+
+from PIL import features
+
+# formats every browser displays, acceptable whenever the Accept header allows image/* or */*;
+# anything else (WebP) is only sent to clients that list it explicitly
+UNIVERSAL_MIMETYPES = {"image/png", "image/jpeg"}
+
+
+class ImageEncoder:
+    def __init__(self, name, mimetype, pil_format, max_dimension=65535, **options):
+        self.name = name
+        self.mimetype = mimetype
+        self.pil_format = pil_format
+        # largest width or height the format can store
+        self.max_dimension = max_dimension
+        self.options = options
+
+    @property
+    def key(self):
+        """Identifies the encoder and its settings, part of every render cache key."""
+        return (self.name, tuple(sorted(self.options.items())))
+
+    def encode(self, image):
+        buffer = io.BytesIO()
+        image.save(buffer, format=self.pil_format, **self.options)
+        return buffer.getvalue()
+
+
+def build_encoders(config):
+    """Encoders available in this deployment, keyed by format name."""
+    encoders = {
+        "png": ImageEncoder("png", "image/png", "PNG", compress_level=config["PNG_COMPRESS_LEVEL"]),
+        "jpeg": ImageEncoder("jpeg", "image/jpeg", "JPEG", quality=config["JPEG_QUALITY"]),
+    }
+    # Pillow may be built without libwebp
+    if features.check("webp"):
+        encoders["webp"] = ImageEncoder("webp", "image/webp", "WEBP", max_dimension=16383,
+                                        lossless=True, method=config["WEBP_METHOD"])
+    return encoders
+
+
+def negotiate_encoder(encoders, accept, requested, preview, formats, preview_format):
+    """
+    Pick the encoder of a response. An explicit, enabled "format" wins; previews
+    use preview_format; otherwise the first of `formats` the client lists in its
+    Accept header is used, and PNG, which every client can display, is the fallback.
+    Returns None for an unknown or disabled requested format.
+    """
+    if requested:
+        if requested not in encoders or (requested not in formats and requested != preview_format):
+            return None
+        return encoders[requested]
+
+    listed = {value for value, quality in accept if quality > 0}
+
+    def acceptable(encoder):
+        if encoder.mimetype in listed:
+            return True
+        return encoder.mimetype in UNIVERSAL_MIMETYPES and (not accept or accept[encoder.mimetype] > 0)
+
+    candidates = ([preview_format] if preview else []) + list(formats)
+    for name in candidates:
+        encoder = encoders.get(name)
+        if encoder is not None and acceptable(encoder):
+            return encoder
+    return encoders["png"]
@@ -0,0 +1,86 @@
+# File: export.py
+#
+# Description: Streaming zip export of DICOM series. The archive is produced by a
+#              generator: each file is copied into the zip in fixed-size chunks and the
+#              compressed bytes are handed to the response as soon as they are written,
+#              so memory use does not grow with the study and the download starts at once.
+#              Files can be de-identified on the way out with pydicom.
+
+import io
+import zipfile
+
+import pydicom
+
+# size of the pieces files are copied into the archive in
+EXPORT_CHUNK_BYTES = 1 << 20
+
+# attributes identifying the patient, blanked on de-identification (subset of the
+# DICOM PS3.15 basic confidentiality profile; UIDs are kept so series stay linked)
+DEIDENTIFY_KEYWORDS = (
+    "PatientName", "PatientID", "PatientBirthDate", "PatientBirthTime", "PatientSex", "PatientAge",
+    "PatientAddress", "PatientTelephoneNumbers", "PatientMotherBirthName", "OtherPatientIDs",
+    "OtherPatientNames", "PatientBirthName", "MilitaryRank", "EthnicGroup", "PatientComments",
+    "ReferringPhysicianName", "PerformingPhysicianName", "OperatorsName", "PhysiciansOfRecord",
+    "RequestingPhysician", "InstitutionName", "InstitutionAddress", "InstitutionalDepartmentName",
+    "StationName", "AccessionNumber", "StudyID", "DeviceSerialNumber",
+)
+
+
+class ZipStream:
+    """Write-only, unseekable file the zip is written to; the written bytes are collected with drain()."""
+
+    def __init__(self):
+        self._chunks = []
+
+    def write(self, data):
+        self._chunks.append(bytes(data))
+        return len(data)
+
+    def flush(self):
+        pass
+
+    def drain(self):
+        data = b"".join(self._chunks)
+        self._chunks = []
+        return data
+
+
+def deidentify(path, pseudonym):
+    """Bytes of a DICOM file with the patient identifying attributes blanked and private tags removed."""
+    ds = pydicom.dcmread(path)
+    for keyword in DEIDENTIFY_KEYWORDS:
+        if keyword in ds:
+            ds.data_element(keyword).value = ""
+    ds.PatientName = pseudonym
+    ds.PatientID = pseudonym
+    ds.remove_private_tags()
+    ds.PatientIdentityRemoved = "YES"
+    ds.DeidentificationMethod = "Basic profile subset, UIDs retained"
+
+    buffer = io.BytesIO()
+    ds.save_as(buffer, enforce_file_format=True)
+    return buffer.getvalue()
+
+
+def iter_zip(members, compress=False, pseudonym=None):
+    """
+    Stream a zip archive of (archive name, file path) members. With a pseudonym
+    every file is de-identified first, which holds one file in memory at a time.
+    """
+    stream = ZipStream()
+    compression = zipfile.ZIP_DEFLATED if compress else zipfile.ZIP_STORED
+    # an unseekable output makes zipfile write sizes in data descriptors after each member
+    with zipfile.ZipFile(stream, "w", compression=compression, compresslevel=1 if compress else None) as archive:
+        for name, path in members:
+            # force_zip64: the size of a member is not known before it is written
+            with archive.open(name, "w", force_zip64=True) as member:
+                if pseudonym is not None:
+                    member.write(deidentify(path, pseudonym))
+                else:
+                    with open(path, "rb") as f:
+                        while chunk := f.read(EXPORT_CHUNK_BYTES):
+                            member.write(chunk)
+                            yield stream.drain()
+            yield stream.drain()
+    # central directory
+    yield stream.drain()
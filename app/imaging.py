@@ -0,0 +1,195 @@
+# File: imaging.py
+#
+# Description: Vectorized window/level rendering of CT slices. Volumes are cached as
+#              int16 rescaled values (Hounsfield units for CT), and each window setting
+#              is turned once into a 65536-entry lookup table so a slice is rendered
+#              to 8-bit grayscale with a single NumPy indexing pass.
+
+import zlib
+from functools import lru_cache
+
+import numpy as np
+from PIL import Image
+
+# named window presets as (center, width) in Hounsfield units
+WINDOW_PRESETS = {
+    "brain": (40, 80),
+    "lung": (-600, 1500),
+    "bone": (400, 1800),
+    "abdomen": (40, 400),
+}
+
+INT16_MIN = np.iinfo(np.int16).min
+INT16_MAX = np.iinfo(np.int16).max
+
+
+def rescale_slice(pixels, slope, intercept):
+    """Apply the DICOM rescale to stored pixel values and return int16 output values."""
+    if slope == 1 and intercept == int(intercept):
+        rescaled = pixels.astype(np.int32) + int(intercept)
+    else:
+        rescaled = np.rint(pixels.astype(np.float32) * slope + intercept)
+    return np.clip(rescaled, INT16_MIN, INT16_MAX).astype(np.int16)
+
+
+@lru_cache(maxsize=64)
+def window_lut(center, width):
+    """
+    Lookup table mapping every int16 value (indexed through its uint16 view)
+    to an 8-bit gray level, using the DICOM linear VOI function. Widths below 2
+    are treated as 2, a hard threshold at the center, as in the browser viewer.
+    """
+    width = max(float(width), 2.0)
+    values = np.arange(65536, dtype=np.uint16).view(np.int16).astype(np.float32)
+    scaled = ((values - (center - 0.5)) / (width - 1.0) + 0.5) * 255.0
+    lut = np.clip(np.rint(scaled), 0, 255).astype(np.uint8)
+    lut.flags.writeable = False
+    return lut
+
+
+def apply_window(hu_slice, center, width):
+    """Window an int16 slice to a uint8 array with one lookup table pass."""
+    return window_lut(float(center), float(width))[hu_slice.view(np.uint16)]
+
+
+def default_window(slice_info, hu_slice):
+    """Window stored in the DICOM header, or the full value range of the slice."""
+    if slice_info.get("window_center") is not None and slice_info.get("window_width"):
+        return slice_info["window_center"], slice_info["window_width"]
+    low, high = int(hu_slice.min()), int(hu_slice.max())
+    return (low + high) / 2, max(high - low, 1)
+
+
+# percentiles reported in the intensity statistics of a series
+STAT_PERCENTILES = (0.5, 1, 5, 25, 50, 75, 95, 99, 99.5)
+
+# number of bins of the coarse histogram kept with the statistics
+HISTOGRAM_BINS = 128
+
+
+def volume_statistics(volume):
+    """
+    Intensity histogram and percentiles of an int16 volume from a single np.histogram
+    pass with one bin per value. Voxels at the volume minimum (padding outside the
+    scanned field of view) are left out of the percentiles, and the auto window
+    spans the 1st to 99th percentile of the remaining voxels.
+    """
+    counts, _ = np.histogram(volume, bins=65536, range=(INT16_MIN, INT16_MAX + 1))
+    values = np.arange(INT16_MIN, INT16_MAX + 1)
+    present = np.flatnonzero(counts)
+    low, high = present[0], present[-1]
+
+    foreground = counts.copy()
+    foreground[low] = 0
+    if not foreground.any():
+        foreground = counts
+    cdf = np.cumsum(foreground)
+    percentiles = {str(q): int(values[np.searchsorted(cdf, cdf[-1] * q / 100)]) for q in STAT_PERCENTILES}
+
+    # coarse histogram over the occupied value range, for display
+    bin_width = -(-(high - low + 1) // HISTOGRAM_BINS)
+    coarse = np.add.reduceat(counts[low:high + 1], np.arange(0, high - low + 1, bin_width))
+
+    p1, p99 = percentiles["1"], percentiles["99"]
+    return {
+        "min": int(values[low]),
+        "max": int(values[high]),
+        "mean": float(counts @ values / counts.sum()),
+        "voxels": int(counts.sum()),
+        "percentiles": percentiles,
+        "auto_window": [(p1 + p99) / 2, max(p99 - p1, 1)],
+        "histogram": {"start": int(values[low]), "bin_width": int(bin_width), "counts": coarse.tolist()},
+    }
+
+
+def render_slice(hu_slice, center, width):
+    """Render an int16 slice as a single-channel PIL image."""
+    return Image.fromarray(apply_window(hu_slice, center, width))
+
+
+# reslicing planes of a volume ordered (slice, row, column) from inferior to superior
+MPR_ORIENTATIONS = ("axial", "coronal", "sagittal")
+
+
+def reslice(volume, orientation, position, geometry):
+    """
+    Extract an orthogonal plane from an int16 volume. Coronal and sagittal planes
+    are resampled along the slice axis (linear interpolation, fully vectorized)
+    so their pixels are square, and flipped so the superior end is at the top.
+    """
+    if orientation == "axial":
+        return volume[position]
+
+    if orientation == "coronal":
+        plane = volume[:, position, :]
+        in_plane_spacing = geometry["pixel_spacing"][1]
+    else:
+        plane = volume[:, :, position]
+        in_plane_spacing = geometry["pixel_spacing"][0]
+
+    count = plane.shape[0]
+    out_rows = max(int(round(count * geometry["slice_spacing"] / in_plane_spacing)), 1)
+    # source slice coordinate of every output row centre
+    source = (np.arange(out_rows) + 0.5) * count / out_rows - 0.5
+    source = np.clip(source, 0, count - 1)
+    lower = np.floor(source).astype(np.intp)
+    upper = np.minimum(lower + 1, count - 1)
+    weight = (source - lower).astype(np.float32)[:, None]
+    resampled = plane[lower] * (1 - weight) + plane[upper] * weight
+    return np.rint(resampled[::-1]).astype(np.int16)
+
+
+# intensity projections along the slice axis, in the order they are stored
+PROJECTIONS = ("mip", "minip", "mean")
+
+
+def compute_projections(volume):
+    """Maximum, minimum and mean intensity projections of a volume as one (3, rows, columns) int16 stack."""
+    mean = np.rint(volume.mean(axis=0, dtype=np.float32)).astype(np.int16)
+    return np.stack([volume.max(axis=0), volume.min(axis=0), mean])
+
+
+def downsample(hu_slice, factor):
+    """
+    Block-mean decimation of an int16 slice by an integer factor, trailing rows
+    and columns that do not fill a whole block are dropped.
+    """
+    if factor <= 1:
+        return hu_slice
+    rows = hu_slice.shape[0] // factor
+    columns = hu_slice.shape[1] // factor
+    blocks = hu_slice[:rows * factor, :columns * factor].reshape(rows, factor, columns, factor)
+    return np.rint(blocks.mean(axis=(1, 3), dtype=np.float32)).astype(np.int16)
+
+
+def render_atlas(hu_slices, center, width, columns):
+    """
+    Render a stack of int16 slices into one grayscale sprite atlas laid out
+    row-major, `columns` tiles per row. Unused trailing tiles are black.
+    """
+    count, height, tile_width = hu_slices.shape
+    rows = -(-count // columns)
+    tiles = np.zeros((rows * columns, height, tile_width), dtype=np.uint8)
+    tiles[:count] = apply_window(hu_slices, center, width)
+    atlas = tiles.reshape(rows, columns, height, tile_width).transpose(0, 2, 1, 3)
+    return Image.fromarray(atlas.reshape(rows * height, columns * tile_width))
+
+
+def iter_raw(array, chunk_bytes=1 << 20, compress=False):
+    """
+    Yield the little-endian int16 bytes of an array in bounded chunks taken from a
+    memoryview over its buffer, optionally zlib-compressed as a deflate stream.
+    WSGI servers only accept bytes, so at most one chunk is copied at a time.
+    """
+    view = memoryview(np.ascontiguousarray(array, dtype="<i2")).cast("B")
+    compressor = zlib.compressobj(1) if compress else None
+    for offset in range(0, view.nbytes, chunk_bytes):
+        chunk = view[offset:offset + chunk_bytes]
+        if compressor is None:
+            yield chunk.tobytes()
+        else:
+            data = compressor.compress(chunk)
+            if data:
+                yield data
+    if compressor is not None:
+        yield compressor.flush()
@@ -0,0 +1,285 @@
+# File: ingest.py
+#
+# Description: DICOM ingest pipeline. An uploaded folder or zip of DICOM files is parsed
+#              header-only in a process pool, grouped by SeriesInstanceUID and moved into
+#              per-patient series folders. The series index and the preprocessed volume of
+#              every series are written in the same pass, so the viewer never has to
+#              decode the study on a request. Ingests run as background jobs in a process
+#              of their own, so web workers only accept the upload and return; job status
+#              is kept in files so every worker process can answer the polls, with a
+#              heartbeat that tells a running job from one whose worker died.
+
+import json
+import multiprocessing
+import os
+import re
+import shutil
+import threading
+import time
+import uuid
+import zipfile
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from datetime import date, datetime
+
+import pydicom
+from pydicom.errors import InvalidDicomError
+
+from app.dicom_index import SeriesIndexRegistry, slice_header
+from app.volume_store import VolumeStore, atomic_write
+
+# DICOM UIDs are digits separated by dots, which also makes them safe folder names
+UID_PATTERN = re.compile(r"^[0-9.]{1,64}$")
+
+# job ids are uuid4 hex strings, anything else never names a status file
+JOB_ID_PATTERN = re.compile(r"^[0-9a-f]{32}$")
+
+
+def patient_series_dir(storage_dir, patient_id, series_uid):
+    """Folder holding the .dcm files of one series of one patient."""
+    if not UID_PATTERN.match(series_uid):
+        raise ValueError(f"invalid series UID {series_uid!r}")
+    return os.path.join(storage_dir, str(int(patient_id)), series_uid)
+
+
+def collect_files(source, staging_dir):
+    """
+    List the candidate files of an upload: every file below a folder, or the
+    members of a zip extracted into staging_dir.
+    """
+    if zipfile.is_zipfile(source):
+        extract_dir = os.path.join(staging_dir, "extracted")
+        with zipfile.ZipFile(source) as archive:
+            # extractall() sanitizes absolute paths and ".." components
+            archive.extractall(extract_dir)
+        source = extract_dir
+
+    paths = []
+    for root, _, names in os.walk(source):
+        for name in names:
+            paths.append(os.path.join(root, name))
+    return paths
+
+
+def read_ingest_header(path):
+    """
+    Header-only read of one uploaded file, run in a worker process.
+    Returns None for files that are not DICOM images.
+    """
+    try:
+        with open(path, "rb") as f:
+            ds = pydicom.dcmread(f, stop_before_pixels=True)
+            pixel_data_offset = f.tell()
+    except (InvalidDicomError, OSError, ValueError):
+        return None
+    if "SeriesInstanceUID" not in ds or "SOPInstanceUID" not in ds or "Rows" not in ds:
+        return None
+
+    return {
+        "path": path,
+        "series_uid": str(ds.SeriesInstanceUID),
+        "sop_uid": str(ds.SOPInstanceUID),
+        "modality": str(ds.get("Modality", "")),
+        "series_description": str(ds.get("SeriesDescription", "")),
+        "acquired": str(ds.get("SeriesDate") or ds.get("StudyDate") or ""),
+        "header": slice_header(ds, pixel_data_offset, os.stat(path)),
+    }
+
+
+def acquisition_date(value):
+    try:
+        return datetime.strptime(value, "%Y%m%d").date()
+    except ValueError:
+        return date.today()
+
+
+def ingest_study(source, patient_id, storage_dir, staging_dir, series_indexes, volume_store, max_workers=None,
+                 move=True):
+    """
+    Ingest every DICOM series found in source for a patient and return one
+    summary dict per series (uid, folder, modality, description, date, slices).
+    Files are moved out of source, or copied when move is False. When the ingest
+    fails, the files it placed and the series folders it created are removed.
+    """
+    paths = collect_files(source, staging_dir)
+
+    # header parsing is CPU bound, spread it over processes in large chunks. The caller may be a
+    # multi-threaded process, where a fork could copy locks held by other threads, so the pool
+    # processes are started from a clean forkserver process instead
+    with ProcessPoolExecutor(max_workers=max_workers, mp_context=multiprocessing.get_context("forkserver")) as pool:
+        headers = [entry for entry in pool.map(read_ingest_header, paths, chunksize=64) if entry]
+
+    series = {}
+    for entry in headers:
+        if UID_PATTERN.match(entry["series_uid"]) and UID_PATTERN.match(entry["sop_uid"]):
+            series.setdefault(entry["series_uid"], []).append(entry)
+
+    summaries = []
+    # new series folders and new files, removed again if the ingest fails
+    created_dirs = []
+    placed_files = []
+    try:
+        for series_uid, entries in series.items():
+            dicom_dir = patient_series_dir(storage_dir, patient_id, series_uid)
+            if not os.path.isdir(dicom_dir):
+                os.makedirs(dicom_dir)
+                created_dirs.append(dicom_dir)
+
+            index_entries = []
+            for entry in entries:
+                filename = entry["sop_uid"] + ".dcm"
+                target = os.path.join(dicom_dir, filename)
+                if not os.path.exists(target):
+                    placed_files.append(target)
+                # move and copy2 keep size and mtime, so the parsed header stays valid for the index
+                transfer = shutil.move if move else shutil.copy2
+                transfer(entry["path"], target)
+                index_entries.append(dict(entry["header"], filename=filename))
+
+            index = series_indexes.get(dicom_dir)
+            index.seed(index_entries)
+            volume = volume_store.ingest(index)
+
+            first = entries[0]
+            summaries.append({
+                "series_uid": series_uid,
+                "dicom_dir": dicom_dir,
+                "modality": first["modality"],
+                "description": first["series_description"],
+                "date_acquired": acquisition_date(first["acquired"]),
+                "num_slices": int(volume.shape[0]),
+            })
+    except BaseException:
+        for path in placed_files:
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+        for dicom_dir in created_dirs:
+            shutil.rmtree(dicom_dir, ignore_errors=True)
+        raise
+    return summaries
+
+
+def ingest_study_process(source, patient_id, storage_dir, staging_dir, index_dir, check_interval, store_dir,
+                         max_workers=None):
+    """
+    ingest_study() with a series index registry and volume store of its own,
+    for running an upload in a separate process. Files are moved.
+    """
+    return ingest_study(source, patient_id, storage_dir, staging_dir, SeriesIndexRegistry(index_dir, check_interval),
+                        VolumeStore(store_dir), max_workers)
+
+
+class IngestJobs:
+    """
+    Background ingest jobs. Uploads are queued on a single thread so a large
+    study never occupies a web worker; the work of each job, decoding included,
+    runs in a process of its own started from a forkserver. The status of every
+    job is written to a JSON file in status_dir, so a poll answered by any
+    worker process finds it; status files older than max_age seconds are removed
+    when a new job is submitted. While this process has jobs it stamps their
+    files every heartbeat_interval seconds; a queued or running job whose stamp
+    is three intervals old lost its worker process and is reported as failed.
+    """
+
+    def __init__(self, status_dir, max_concurrent=1, max_age=24 * 3600, heartbeat_interval=10):
+        self.status_dir = status_dir
+        self.max_age = max_age
+        self.heartbeat_interval = heartbeat_interval
+        self._executor = ThreadPoolExecutor(max_workers=max_concurrent, thread_name_prefix="ingest")
+        # jobs run by this process, by id
+        self._jobs = {}
+        self._heartbeat = None
+        self._lock = threading.Lock()
+
+    def submit(self, work, args, on_done=None, cleanup_dir=None):
+        """
+        Queue work(*args) -> list of series summaries, run in a separate process
+        (work and args must be picklable). on_done(summaries) is then called on the
+        job thread of this process, e.g. to record the series in the database.
+        Return the job id.
+        """
+        os.makedirs(self.status_dir, exist_ok=True)
+        self._remove_expired()
+        job_id = uuid.uuid4().hex
+        with self._lock:
+            self._jobs[job_id] = {"id": job_id, "state": "queued", "series": [], "error": None,
+                                  "heartbeat": time.time()}
+            if self._heartbeat is None:
+                self._heartbeat = threading.Thread(target=self._beat, name="ingest-heartbeat", daemon=True)
+                self._heartbeat.start()
+        self._update(job_id)
+        self._executor.submit(self._run, job_id, work, args, on_done, cleanup_dir)
+        return job_id
+
+    def status(self, job_id):
+        """Status of a job submitted by any worker process, or None for an unknown id."""
+        if not JOB_ID_PATTERN.match(job_id):
+            return None
+        try:
+            with open(self._path(job_id)) as f:
+                job = json.load(f)
+        except (OSError, ValueError):
+            return None
+        if job["state"] in ("queued", "running") and time.time() - job["heartbeat"] > 3 * self.heartbeat_interval:
+            job.update(state="failed", error="the ingest was interrupted, upload the files again")
+        return job
+
+    def _path(self, job_id):
+        return os.path.join(self.status_dir, job_id + ".json")
+
+    def _update(self, job_id, **fields):
+        with self._lock:
+            job = self._jobs[job_id]
+            job.update(fields)
+            data = json.dumps(job).encode()
+            # written under the lock, so a heartbeat never puts an older state back
+            atomic_write(self._path(job_id), lambda f: f.write(data), suffix=".json")
+
+    def _beat(self):
+        while True:
+            time.sleep(self.heartbeat_interval)
+            with self._lock:
+                job_ids = list(self._jobs)
+                if not job_ids:
+                    self._heartbeat = None
+                    return
+            for job_id in job_ids:
+                try:
+                    self._update(job_id, heartbeat=time.time())
+                except (KeyError, OSError):
+                    # finished meanwhile
+                    pass
+
+    def _remove_expired(self):
+        cutoff = time.time() - self.max_age
+        for entry in os.scandir(self.status_dir):
+            try:
+                if entry.name.endswith(".json") and entry.stat().st_mtime < cutoff:
+                    os.remove(entry.path)
+            except OSError:
+                pass
+
+    def _run(self, job_id, work, args, on_done, cleanup_dir):
+        self._update(job_id, state="running")
+        try:
+            # a fresh process per job hands the memory of decoding a large study back when it ends
+            with ProcessPoolExecutor(max_workers=1, mp_context=multiprocessing.get_context("forkserver")) as process:
+                summaries = process.submit(work, *args).result()
+            if on_done is not None:
+                on_done(summaries)
+        except Exception as error:
+            self._update(job_id, state="failed", error=str(error))
+        else:
+            # server paths stay private, the status is served to browsers
+            series = [{key: value for key, value in summary.items() if key != "dicom_dir"}
+                      for summary in summaries]
+            for summary in series:
+                summary["date_acquired"] = summary["date_acquired"].isoformat()
+            self._update(job_id, state="done", series=series)
+        finally:
+            with self._lock:
+                # the status file is the record from here on
+                self._jobs.pop(job_id, None)
+            if cleanup_dir:
+                shutil.rmtree(cleanup_dir, ignore_errors=True)
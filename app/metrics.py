@@ -0,0 +1,133 @@
+# File: metrics.py
+#
+# Description: In-process metrics exposed in the Prometheus text format. Histograms are
+#              plain Python objects updated under a lock, cheap enough to record on every
+#              request, query and rendered slice. Each worker process keeps its own values,
+#              like every other in-process cache of the app, so a scrape reports the worker
+#              that answered it.
+
+import bisect
+import threading
+import time
+from contextlib import contextmanager
+
+# request and query latencies, in seconds
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+# SQL queries run by one request
+QUERY_COUNT_BUCKETS = (0, 1, 2, 3, 5, 10, 20, 50, 100)
+
+
+def format_labels(names, values):
+    if not names:
+        return ""
+    pairs = []
+    for name, value in zip(names, values):
+        value = str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+        pairs.append(f'{name}="{value}"')
+    return "{" + ",".join(pairs) + "}"
+
+
+def format_value(value):
+    if value == float("inf"):
+        return "+Inf"
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class Histogram:
+    """Cumulative histogram per label combination, with the sum and count of observations."""
+
+    def __init__(self, name, documentation, labelnames=(), buckets=LATENCY_BUCKETS):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self.buckets = tuple(buckets)
+        # labels -> [per-bucket counts (last one is +Inf), sum]
+        self._series = {}
+        self._lock = threading.Lock()
+
+    def observe(self, value, *labels):
+        position = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            series = self._series.get(labels)
+            if series is None:
+                series = self._series[labels] = [[0] * (len(self.buckets) + 1), 0.0]
+            series[0][position] += 1
+            series[1] += value
+
+    @contextmanager
+    def time(self, *labels):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - start, *labels)
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} histogram"]
+        with self._lock:
+            series = sorted((labels, list(counts), total) for labels, (counts, total) in self._series.items())
+        names = self.labelnames + ("le",)
+        for labels, counts, total in series:
+            cumulative = 0
+            for bound, count in zip(self.buckets + (float("inf"),), counts):
+                cumulative += count
+                lines.append(f"{self.name}_bucket{format_labels(names, labels + (format_value(bound),))} {cumulative}")
+            lines.append(f"{self.name}_sum{format_labels(self.labelnames, labels)} {format_value(total)}")
+            lines.append(f"{self.name}_count{format_labels(self.labelnames, labels)} {cumulative}")
+        return lines
+
+
+class CallbackMetric:
+    """
+    Gauge or counter kept elsewhere and read when the metrics are scraped;
+    collect() returns {labels tuple: value}.
+    """
+
+    def __init__(self, name, documentation, kind, labelnames, collect):
+        self.name = name
+        self.documentation = documentation
+        self.kind = kind
+        self.labelnames = tuple(labelnames)
+        self.collect = collect
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} {self.kind}"]
+        for labels, value in sorted(self.collect().items()):
+            lines.append(f"{self.name}{format_labels(self.labelnames, labels)} {format_value(value)}")
+        return lines
+
+
+class Registry:
+    def __init__(self):
+        self._metrics = []
+
+    def register(self, metric):
+        self._metrics.append(metric)
+        return metric
+
+    def render(self):
+        lines = []
+        for metric in self._metrics:
+            lines.extend(metric.render())
+        return "\n".join(lines) + "\n"
+
+
+registry = Registry()
+
+http_request_seconds = registry.register(Histogram(
+    "http_request_duration_seconds", "Time to produce a response, by route, method and status.",
+    ("route", "method", "status")))
+http_request_queries = registry.register(Histogram(
+    "http_request_sql_queries", "SQL queries run by one request, by route.", ("route",), QUERY_COUNT_BUCKETS))
+http_request_query_seconds = registry.register(Histogram(
+    "http_request_sql_seconds", "Time one request spent in SQL queries, by route.", ("route",)))
+sql_query_seconds = registry.register(Histogram(
+    "sql_query_duration_seconds", "Time of single SQL statements, by access path (raw cursor or orm).",
+    ("source",)))
+db_pool_wait_seconds = registry.register(Histogram(
+    "db_pool_wait_seconds", "Time a checkout waited for a pooled connection."))
+dicom_stage_seconds = registry.register(Histogram(
+    "dicom_stage_duration_seconds",
+    "Time of the stages of serving a slice: read (DICOM files parsed), decode (pixel data decoded), "
+    "load (volume slice fetched), window (downsample and window) and encode (image compression).",
+    ("stage",)))
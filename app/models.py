@@ -10,6 +10,15 @@ class Patient(db.Model):
     date_of_birth = db.Column(db.Date, nullable=False)
     diagnosis = db.Column(db.String(200), nullable=False)
 
+    # indexes behind the sorted, filtered and keyset-paginated patient list; InnoDB appends
+    # the primary key to every secondary index, which covers the id tie-breaker
+    __table_args__ = (
+        db.Index('ix_patient_name', 'name'),
+        db.Index('ix_patient_date_of_birth', 'date_of_birth'),
+        db.Index('ix_patient_diagnosis_name', 'diagnosis', 'name'),
+        db.Index('ix_patient_diagnosis_date_of_birth', 'diagnosis', 'date_of_birth'),
+    )
+
 # PatientObj model
 class PatientObj:
     def __init__(self, id, name, date_of_birth, diagnosis):
@@ -62,14 +71,17 @@ class MedicalImage(db.Model):
     patient = db.relationship("Patient", backref=db.backref("images", cascade="all, delete-orphan"))
     type = db.Column(db.String(100), nullable=False)
     date_acquired = db.Column(db.Date, nullable=False)
-    
+    # SeriesInstanceUID of the ingested DICOM series holding the pixel data, if any
+    series_uid = db.Column(db.String(64), nullable=True)
+
 # MedicalImageObj model
 class MedicalImageObj:
-    def __init__(self, id, patient_id, type, date_acquired):
+    def __init__(self, id, patient_id, type, date_acquired, series_uid=None):
         self.id = id
         self.patient_id = patient_id
         self.type = type
         self.date_acquired = date_acquired
+        self.series_uid = series_uid
 
 class Diagnosis(db.Model):
     __tablename__ = 'Diagnosis'
@@ -79,4 +91,18 @@ class Diagnosis(db.Model):
 class DiagnosisObj:
     def __init__(self, id, name):
         self.id = id
-        self.name = name
\ No newline at end of file
+        self.name = name
+
+# PatientAggregate: a patient with all of its child rows, as loaded for the edit and view pages
+class PatientAggregate:
+    def __init__(self, patient, plans, machine, images):
+        self.patient = patient
+        self.plans = plans
+        self.machine = machine
+        self.images = images
+
+    # ingested DICOM series of the patient, most recent first
+    @property
+    def series_images(self):
+        images = [image for image in self.images if image.series_uid]
+        return sorted(images, key=lambda image: image.date_acquired, reverse=True)
@@ -0,0 +1,93 @@
+# File: prefetch.py
+#
+# Description: Background prefetch of neighbouring slices. When slice i is served, slices
+#              i±1 .. i±depth are rendered into the render cache by a small thread pool so
+#              the next slider ticks are cache hits. The pool is bounded: tasks are dropped
+#              instead of queued when too many are pending, and queued tasks are skipped
+#              once the viewer has moved far away from them.
+
+import logging
+import threading
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+
+logger = logging.getLogger(__name__)
+
+
+class SlicePrefetcher:
+    """
+    max_workers threads run prefetch tasks; at most max_pending tasks are queued
+    or running at once, further requests are dropped so prefetching never builds
+    a backlog competing with foreground requests. depth is the number of slices
+    prefetched on each side of the requested one. The latest slice is remembered
+    for the max_focus most recently viewed series keys only, since keys include
+    client supplied render settings.
+    """
+
+    def __init__(self, max_workers, depth, max_pending, max_focus=256):
+        self.depth = depth
+        self.max_focus = max_focus
+        self._executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="prefetch")
+        self._pending = threading.BoundedSemaphore(max_pending)
+        # latest slice requested per series key in LRU order, used to cancel stale tasks
+        self._focus = OrderedDict()
+        self._lock = threading.Lock()
+
+    def focus(self, series_key, slice_index, num_slices, render):
+        """
+        Record that slice_index of a series was requested and prefetch its
+        neighbours by calling render(neighbour_index) in the background.
+        """
+        with self._lock:
+            self._focus[series_key] = slice_index
+            self._focus.move_to_end(series_key)
+            # tasks of an evicted key find no focus and are skipped
+            while len(self._focus) > self.max_focus:
+                self._focus.popitem(last=False)
+
+        # nearest neighbours first, so they are the ones kept under backpressure
+        for offset in range(1, self.depth + 1):
+            for neighbour in (slice_index + offset, slice_index - offset):
+                if 0 <= neighbour < num_slices:
+                    if not self._submit(self._prefetch, series_key, neighbour, render):
+                        return
+
+    def forget(self, series_key):
+        """Drop the focus of a series key that will not be requested again, its queued tasks are skipped."""
+        with self._lock:
+            self._focus.pop(series_key, None)
+
+    def warm(self, task):
+        """Run a one-off warm-up task (e.g. loading a volume) in the background."""
+        return self._submit(self._run, task)
+
+    def shutdown(self):
+        self._executor.shutdown(wait=False, cancel_futures=True)
+
+    def _submit(self, fn, *args):
+        # backpressure: never block the request thread, drop the task instead
+        if not self._pending.acquire(blocking=False):
+            return False
+        try:
+            self._executor.submit(fn, *args)
+        except RuntimeError:
+            self._pending.release()
+            return False
+        return True
+
+    def _prefetch(self, series_key, slice_index, render):
+        with self._lock:
+            focus = self._focus.get(series_key)
+        # the viewer jumped away since this task was queued
+        if focus is None or abs(focus - slice_index) > self.depth:
+            self._pending.release()
+            return
+        self._run(lambda: render(slice_index))
+
+    def _run(self, task):
+        try:
+            task()
+        except Exception:
+            logger.exception("prefetch task failed")
+        finally:
+            self._pending.release()
@@ -0,0 +1,127 @@
+# File: read_cache.py
+#
+# Description: Small in-process read-through caches for database reads. Values are loaded
+#              on a miss, kept in an LRU of bounded size and dropped by the write routes
+#              that change them. Every worker process has its own cache, so entries also
+#              expire after a short time to bound how long writes made by another process
+#              stay invisible. Lookup tables are cached whole and revalidated with a
+#              version stamp query instead of being read again.
+
+import threading
+import time
+from collections import OrderedDict
+
+
+class ReadThroughCache:
+    """
+    LRU of at most max_entries values, each served for at most ttl seconds.
+    load() results of None are not cached. Every invalidate() bumps a generation
+    counter of its key, and a load that was running across an invalidation is
+    returned to its caller but not stored, so it cannot put a stale value back.
+    """
+
+    def __init__(self, max_entries, ttl):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self._entries = OrderedDict()
+        # invalidations of the keys with loads in flight, and the number of those loads
+        self._generations = {}
+        self._loading = {}
+        self._lock = threading.Lock()
+
+    def get(self, key, load):
+        """Return the cached value for key, calling load() to read it on a miss."""
+        now = time.monotonic()
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and entry[0] > now:
+                self._entries.move_to_end(key)
+                return entry[1]
+            generation = self._generations.get(key, 0)
+            self._loading[key] = self._loading.get(key, 0) + 1
+
+        value = None
+        try:
+            value = load()
+        finally:
+            with self._lock:
+                if value is not None and self._generations.get(key, 0) == generation:
+                    self._entries[key] = (now + self.ttl, value)
+                    self._entries.move_to_end(key)
+                    while len(self._entries) > self.max_entries:
+                        self._entries.popitem(last=False)
+                self._loading[key] -= 1
+                if not self._loading[key]:
+                    del self._loading[key]
+                    self._generations.pop(key, None)
+        return value
+
+    def invalidate(self, key):
+        with self._lock:
+            self._entries.pop(key, None)
+            if key in self._loading:
+                self._generations[key] = self._generations.get(key, 0) + 1
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            for key in self._loading:
+                self._generations[key] = self._generations.get(key, 0) + 1
+
+
+class ReferenceTable:
+    """
+    Process-wide copy of a small lookup table. load() reads the rows and
+    version() a cheap version stamp of the table. The rows are served from
+    memory; ttl seconds after the last check the stamp is read again and the
+    rows are only reloaded when it changed. One caller at a time refreshes,
+    outside the lock, while the others keep getting the rows they had; only the
+    first load, with no rows yet, makes them wait. invalidate() forces a reload
+    on the next get(), for writes made by this process.
+    """
+
+    def __init__(self, load, version, ttl):
+        self.load = load
+        self.version = version
+        self.ttl = ttl
+        self._rows = None
+        self._stamp = None
+        self._checked_at = 0.0
+        # a refresh in flight, and invalidations a refresh that started before must not undo
+        self._refreshing = False
+        self._generation = 0
+        self._lock = threading.Condition(threading.Lock())
+
+    def get(self):
+        with self._lock:
+            while True:
+                now = time.monotonic()
+                if self._rows is not None and (self._refreshing or now - self._checked_at < self.ttl):
+                    return self._rows
+                if not self._refreshing:
+                    break
+                self._lock.wait()
+            self._refreshing = True
+            rows, known_stamp, generation = self._rows, self._stamp, self._generation
+
+        loaded = False
+        try:
+            # the stamp is read before the rows, so a write in between shows up at the next check
+            stamp = self.version()
+            if rows is None or stamp != known_stamp:
+                rows = self.load()
+            loaded = True
+        finally:
+            with self._lock:
+                if loaded and generation == self._generation:
+                    self._rows = rows
+                    self._stamp = stamp
+                    self._checked_at = now
+                self._refreshing = False
+                self._lock.notify_all()
+        return rows
+
+    def invalidate(self):
+        with self._lock:
+            self._rows = None
+            self._generation += 1
@@ -0,0 +1,141 @@
+# File: render_cache.py
+#
+# Description: Content-addressed cache of encoded slice images. A rendered image is
+#              keyed by everything that affects its bytes (series version, slice,
+#              window, size, format), kept in a small in-memory LRU tier and backed by
+#              an on-disk tier with atomic writes and a total size cap. A repeated
+#              request never reaches the DICOM decoder or the image encoder.
+
+import hashlib
+import os
+import tempfile
+import threading
+from collections import OrderedDict
+
+
+def render_key(*parts):
+    """Stable content address for the render parameters."""
+    return hashlib.sha1(repr(parts).encode()).hexdigest()
+
+
+class RenderCache:
+    """
+    Two-tier cache of encoded images.
+
+    max_memory_bytes bounds the in-memory LRU tier, max_disk_bytes bounds the
+    files under cache_dir. When the disk tier grows past its cap the least
+    recently used files are removed until it is back under 90% of the cap.
+    """
+
+    def __init__(self, cache_dir, max_memory_bytes, max_disk_bytes):
+        self.cache_dir = cache_dir
+        self.max_memory_bytes = max_memory_bytes
+        self.max_disk_bytes = max_disk_bytes
+        self._memory = OrderedDict()
+        self._memory_bytes = 0
+        self._disk_bytes = None
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            data = self._memory.get(key)
+            if data is not None:
+                self._memory.move_to_end(key)
+                return data
+
+        path = self._path(key)
+        try:
+            with open(path, "rb") as f:
+                data = f.read()
+            # mark the file as recently used for disk eviction
+            os.utime(path)
+        except OSError:
+            return None
+        self._remember(key, data)
+        return data
+
+    def put(self, key, data):
+        self._remember(key, data)
+        self._write(key, data)
+
+    def get_or_render(self, key, render):
+        """Return the cached bytes for key, calling render() to produce them on a miss."""
+        data = self.get(key)
+        if data is None:
+            data = render()
+            self.put(key, data)
+        return data
+
+    def _path(self, key):
+        return os.path.join(self.cache_dir, key[:2], key)
+
+    def _remember(self, key, data):
+        if len(data) > self.max_memory_bytes:
+            return
+        with self._lock:
+            previous = self._memory.pop(key, None)
+            if previous is not None:
+                self._memory_bytes -= len(previous)
+            self._memory[key] = data
+            self._memory_bytes += len(data)
+            while self._memory_bytes > self.max_memory_bytes:
+                _, evicted = self._memory.popitem(last=False)
+                self._memory_bytes -= len(evicted)
+
+    def _write(self, key, data):
+        path = self._path(key)
+        directory = os.path.dirname(path)
+        os.makedirs(directory, exist_ok=True)
+
+        # write to a temporary file and rename so readers never see a partial image,
+        # concurrent writers of the same key simply replace each other's identical bytes
+        fd, tmp_path = tempfile.mkstemp(dir=directory, suffix=".tmp")
+        try:
+            with os.fdopen(fd, "wb") as f:
+                f.write(data)
+            os.replace(tmp_path, path)
+        except OSError:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+            return
+
+        with self._lock:
+            if self._disk_bytes is None:
+                self._disk_bytes = self._scan_disk_bytes()
+            else:
+                self._disk_bytes += len(data)
+            over_cap = self._disk_bytes > self.max_disk_bytes
+        if over_cap:
+            self._trim_disk()
+
+    def _cached_files(self):
+        files = []
+        for root, _, names in os.walk(self.cache_dir):
+            for name in names:
+                if name.endswith(".tmp"):
+                    continue
+                path = os.path.join(root, name)
+                try:
+                    stat = os.stat(path)
+                except OSError:
+                    continue
+                files.append((stat.st_mtime, stat.st_size, path))
+        return files
+
+    def _scan_disk_bytes(self):
+        return sum(size for _, size, _ in self._cached_files())
+
+    def _trim_disk(self):
+        files = sorted(self._cached_files())
+        total = sum(size for _, size, _ in files)
+        target = self.max_disk_bytes * 0.9
+        for _, size, path in files:
+            if total <= target:
+                break
+            try:
+                os.remove(path)
+            except OSError:
+                continue
+            total -= size
+        with self._lock:
+            self._disk_bytes = total
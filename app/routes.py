@@ -6,14 +6,34 @@
 #               and pydicom for DICOM manipulations
 
 from app import app
-from flask import render_template, request, redirect, url_for, send_file, g
+from flask import render_template, request, redirect, url_for, g, abort, Response, jsonify, has_request_context
+from werkzeug.wsgi import wrap_file
 from app.models import Patient, TreatmentPlan, TreatmentMachine, MedicalImage, Diagnosis
-from app.models import PatientObj, TreatmentPlanObj, TreatmentMachineObj, MedicalImageObj, DiagnosisObj
-from app import cnxpool, cnx
+from app.models import PatientObj, TreatmentPlanObj, TreatmentMachineObj, MedicalImageObj, DiagnosisObj, PatientAggregate
+from app import cnxpool
+from app.db_pool import PoolTimeout
+from app.dicom_cache import VolumeCache
+from app.dicom_index import SeriesIndexRegistry, series_geometry
+from app.volume_store import VolumeStore
+from app.imaging import WINDOW_PRESETS, MPR_ORIENTATIONS, PROJECTIONS, default_window, render_slice, render_atlas, reslice, downsample, iter_raw
+from app.render_cache import RenderCache, render_key
+from app.prefetch import SlicePrefetcher
+from app.ingest import IngestJobs, ingest_study_process, patient_series_dir
+from app.encoders import build_encoders, negotiate_encoder
+from app.cine import cine_frames, paced
+from app.export import iter_zip
+from app.search import PatientSearchIndex
+from app.read_cache import ReadThroughCache, ReferenceTable
+from app import metrics
+import base64
+import json
+import math
 import os
-import pydicom
-from PIL import Image
+import time
+import uuid
 from app import db
+from sqlalchemy import and_, or_, func, literal, null, select, union_all, event
+from sqlalchemy.engine import Engine
 from datetime import datetime
 
 """
@@ -22,326 +42,802 @@ In Flask, the 'g' object is a global object that can be used to store data durin
 In this case, we use the g object to store a database connection that needs to be 
 reused by multiple routes during a request. 
 
-This allows use to define decorators that can be used to get and release a database connection.
+The connection is taken from the pool on the first get_db() call of a request and released when
+the request ends, so requests that never query (slice images, static files) use no pool capacity.
 This in turn allows us to avoid resource leaks and potential performance issues.
-
-You can also avoid the decorators and use cnx instead of g.db, wherever defined in the routings.
 """
 
-# Define a Flask before_request handler that gets a database connection 
-# from the connection pool and stores it in the g object.
-@app.before_request
+# Return the database connection of the current request, checking one out of the
+# connection pool and storing it in the g object on first use
 def get_db():
-    g.db = cnxpool.get_connection()
+    if 'db' not in g:
+        g.db = cnxpool.get_connection()
+        g.db_wait = g.db.wait
+    return g.db
 
 # Define a Flask teardown_request handler to release the database connection
 @app.teardown_request
 def release_db(error):
-    if hasattr(g, 'db'):
-        g.db.close()
+    db_connection = g.pop('db', None)
+    if db_connection is not None:
+        db_connection.close()
+
+# Start the latency and SQL counters of a request, before any other handler runs
+@app.before_request
+def start_request_metrics():
+    g.request_start = time.perf_counter()
+    g.sql_queries = 0
+    g.sql_seconds = 0.0
+
+# Record the latency and SQL statements of a request under its route rule
+@app.after_request
+def record_request_metrics(response):
+    if 'request_start' in g:
+        route = request.url_rule.rule if request.url_rule else 'unmatched'
+        metrics.http_request_seconds.observe(time.perf_counter() - g.request_start, route, request.method,
+                                             response.status_code)
+        metrics.http_request_queries.observe(g.sql_queries, route)
+        metrics.http_request_query_seconds.observe(g.sql_seconds, route)
+    return response
+
+# Time of one SQL statement, counted against the current request when there is one
+def record_query(source, seconds):
+    metrics.sql_query_seconds.observe(seconds, source)
+    if has_request_context() and 'sql_queries' in g:
+        g.sql_queries += 1
+        g.sql_seconds += seconds
+
+# statements of the raw cursors are timed by the pool, those of the ORM by SQLAlchemy events
+cnxpool.on_query = lambda seconds: record_query('raw', seconds)
+cnxpool.on_checkout = metrics.db_pool_wait_seconds.observe
+
+@event.listens_for(Engine, 'before_cursor_execute')
+def start_orm_query(conn, cursor, statement, parameters, context, executemany):
+    conn.info.setdefault('query_start', []).append(time.perf_counter())
+
+@event.listens_for(Engine, 'after_cursor_execute')
+def end_orm_query(conn, cursor, statement, parameters, context, executemany):
+    record_query('orm', time.perf_counter() - conn.info['query_start'].pop())
+
+@event.listens_for(Engine, 'handle_error')
+def failed_orm_query(context):
+    if context.connection is not None and context.connection.info.get('query_start'):
+        context.connection.info['query_start'].pop()
+
+# pool state is read from the pool when the metrics are scraped
+def pool_connections():
+    stats = cnxpool.stats()
+    return {(state,): stats[state] for state in ('checked_out', 'idle', 'waiting')}
+
+metrics.registry.register(metrics.CallbackMetric(
+    'db_pool_connections', 'Pooled database connections by state.', 'gauge', ('state',), pool_connections))
+metrics.registry.register(metrics.CallbackMetric(
+    'db_pool_timeouts_total', 'Checkouts that gave up waiting for a pooled connection.', 'counter', (),
+    lambda: {(): cnxpool.stats()['timeouts']}))
+
+# Report the time spent waiting for a pooled connection to the browser's network panel
+@app.after_request
+def report_db_wait(response):
+    if 'db_wait' in g:
+        response.headers.add('Server-Timing', f"db-wait;dur={g.db_wait * 1000:.1f}")
+    return response
+
+# A burst of requests waits for pooled connections; one that waits too long gets a 503 to retry
+@app.errorhandler(PoolTimeout)
+def database_busy(error):
+    return Response("Database busy, try again shortly", status=503, mimetype="text/plain", headers={"Retry-After": "1"})
 
 # full path to the project directory
 BASE_DIR = os.path.dirname(os.path.abspath(__file__))
 
+# folder holding the bundled sample CT series
+SAMPLE_DICOM_DIR = BASE_DIR + "/static/dicom"
+
 # Global variable to toggle between ORM and SQL
 USE_ORM = False
 
-# Home page
-@app.route('/')
-def home():
+# header indexes of the DICOM series folders, persisted across restarts
+series_indexes = SeriesIndexRegistry(os.path.join(app.config['DICOM_CACHE_DIR'], 'index'), app.config['DICOM_INDEX_CHECK_INTERVAL'],
+                                     app.config['DICOM_INDEX_MAX_SERIES'])
+
+# preprocessed volumes on disk, memory-mapped so every worker shares the page cache
+volume_store = VolumeStore(app.config['VOLUME_STORE_DIR'])
+
+# CT volumes opened by this process, mapped from the volume store
+volume_cache = VolumeCache(app.config['DICOM_CACHE_MAX_BYTES'], volume_store)
+
+# encoded slice images keyed by series version and render parameters
+render_cache = RenderCache(os.path.join(app.config['DICOM_CACHE_DIR'], 'rendered'),
+                           app.config['RENDER_CACHE_MEMORY_BYTES'], app.config['RENDER_CACHE_DISK_BYTES'])
+
+# background pool rendering the neighbours of requested slices into the render cache
+prefetcher = SlicePrefetcher(app.config['PREFETCH_WORKERS'], app.config['PREFETCH_DEPTH'], app.config['PREFETCH_MAX_PENDING'])
+
+# image encoders enabled for this deployment
+encoders = build_encoders(app.config)
+
+# DICOM uploads are ingested in the background, one study at a time; job status files are shared by all workers
+ingest_jobs = IngestJobs(os.path.join(app.config['DICOM_UPLOAD_DIR'], 'jobs'))
+
+# Rows of the patient search index. Runs outside of requests, so it uses a pooled connection of its own
+def load_search_rows():
     if USE_ORM:
-        patients = Patient.query.all()
-    else:
-        cursor = g.db.cursor(dictionary=True)
-        query = "SELECT id, name, date_of_birth, diagnosis FROM Patient"
-        cursor.execute(query)
-        patients = []
-        for row in cursor:
-            patient = PatientObj(row['id'], row['name'], row['date_of_birth'], row['diagnosis'])
-            patients.append(patient)
+        with app.app_context():
+            return db.session.query(Patient.id, Patient.name, Patient.diagnosis).all()
+    connection = cnxpool.get_connection()
+    try:
+        cursor = connection.cursor()
+        cursor.execute("SELECT id, name, diagnosis FROM Patient")
+        rows = cursor.fetchall()
+        cursor.close()
+        return rows
+    finally:
+        connection.close()
+
+# patients with their child rows by id, dropped by the routes writing them
+patient_cache = ReadThroughCache(app.config['PATIENT_CACHE_SIZE'], app.config['PATIENT_CACHE_TTL'])
+
+# Rows and version stamp of the Diagnosis lookup table. The stamp covers inserts, deletes and renames
+def load_diagnoses():
+    if USE_ORM:
+        return [DiagnosisObj(diagnosis.id, diagnosis.name) for diagnosis in Diagnosis.query.order_by(Diagnosis.id)]
+    cursor = get_db().cursor(dictionary=True)
+    cursor.execute("SELECT id, name FROM Diagnosis ORDER BY id")
+    diagnoses = [DiagnosisObj(row['id'], row['name']) for row in cursor]
+    cursor.close()
+    return diagnoses
+
+def diagnoses_version():
+    if USE_ORM:
+        return tuple(db.session.query(func.count(), func.max(Diagnosis.id), func.sum(func.crc32(Diagnosis.name))).one())
+    cursor = get_db().cursor()
+    cursor.execute("SELECT COUNT(*), MAX(id), SUM(CRC32(name)) FROM Diagnosis")
+    stamp = cursor.fetchone()
+    cursor.close()
+    return tuple(stamp)
 
+# Machine names and energies in use, offered as suggestions on the patient forms. Like the Diagnosis
+# stamp, the machine stamp covers inserts, deletes and edits of the name or energy
+def load_machine_options():
+    if USE_ORM:
+        rows = db.session.query(TreatmentMachine.name, TreatmentMachine.energy).distinct().all()
+    else:
+        cursor = get_db().cursor()
+        cursor.execute("SELECT DISTINCT name, energy FROM TreatmentMachine")
+        rows = cursor.fetchall()
         cursor.close()
+    return {'names': sorted({name for name, _ in rows}), 'energies': sorted({energy for _, energy in rows})}
+
+def machines_version():
+    if USE_ORM:
+        contents = func.sum(func.crc32(func.concat_ws('|', TreatmentMachine.name, TreatmentMachine.energy)))
+        return tuple(db.session.query(func.count(), func.max(TreatmentMachine.id), contents).one())
+    cursor = get_db().cursor()
+    cursor.execute("SELECT COUNT(*), MAX(id), SUM(CRC32(CONCAT_WS('|', name, energy))) FROM TreatmentMachine")
+    stamp = cursor.fetchone()
+    cursor.close()
+    return tuple(stamp)
+
+# lookup tables of the patient forms, shared by every request of the process
+diagnosis_table = ReferenceTable(load_diagnoses, diagnoses_version, app.config['REFERENCE_DATA_TTL'])
+machine_table = ReferenceTable(load_machine_options, machines_version, app.config['REFERENCE_DATA_TTL'])
 
-    return render_template('home.html', patients=patients)
+# trigram index behind the patient search
+search_index = PatientSearchIndex(load_search_rows, app.config['SEARCH_INDEX_MAX_AGE'],
+                                  app.config['SEARCH_INDEX_RETRY_INTERVAL'])
+
+# Resolve the display window of a slice from the "window" preset name, "window=auto" or the
+# "wc"/"ww" query parameters. Returns None when the window stored in the DICOM header should be used,
+# and 'auto' for the auto window, which depends only on the series version and so goes into render
+# keys and ETags as is; display_window() computes it when an image is actually rendered.
+def window_from_args(args):
+    preset = args.get('window')
+    if preset == 'auto':
+        return preset
+    if preset:
+        if preset not in WINDOW_PRESETS:
+            abort(400)
+        return WINDOW_PRESETS[preset]
+
+    center = args.get('wc', type=float)
+    width = args.get('ww', type=float)
+    if center is None or width is None:
+        return None
+    # nan and inf parse as floats but render nothing useful, and each would be a new cache entry
+    if not math.isfinite(center) or not math.isfinite(width) or width <= 0:
+        abort(400)
+    return center, width
+
+# Window spanning the 1st to 99th intensity percentile of a series. The statistics are computed
+# at ingest (or once for older series) and kept in memory, so this is a dictionary lookup
+def auto_window(index):
+    stats = volume_store.statistics(index, lambda: volume_cache.get_volume(index))
+    return tuple(stats['auto_window'])
+
+# Center and width a slice is rendered with: the requested window, the auto window of the series,
+# or the window of the DICOM header (estimated from the pixels when the header has none)
+def display_window(window, index, header, pixels):
+    if window == 'auto':
+        return auto_window(index)
+    return window or default_window(header, pixels)
+
+# Integer downsampling factor from the "size" (longest edge in pixels) or "quality=preview"
+# query parameters, 1 for full resolution
+def downsample_factor_from_args(args, rows, columns):
+    size = args.get('size', type=int)
+    if size is not None:
+        if size <= 0:
+            abort(400)
+        return max(math.ceil(max(rows, columns) / size), 1)
+    if args.get('quality') == 'preview':
+        return app.config['PREVIEW_FACTOR']
+    return 1
+
+# Encoder of an image response, from the "format" query parameter or the Accept header
+def encoder_from_args(args, preview=False):
+    encoder = negotiate_encoder(encoders, request.accept_mimetypes, args.get('format'), preview,
+                                app.config['IMAGE_FORMATS'], app.config['PREVIEW_FORMAT'])
+    if encoder is None:
+        abort(400)
+    return encoder
+
+# Series selected with the "patient" and "series" query parameters, the bundled sample series otherwise
+def series_index_from_args(args):
+    return series_index(args.get('patient', type=int), args.get('series'))
+
+# Index of an ingested series of a patient, the bundled sample series when none is given
+def series_index(patient_id, series_uid):
+    if patient_id is None or not series_uid:
+        return series_indexes.get(SAMPLE_DICOM_DIR)
+
+    try:
+        dicom_dir = patient_series_dir(app.config['DICOM_STORAGE_DIR'], patient_id, series_uid)
+    except ValueError:
+        abort(404)
+    if not os.path.isdir(dicom_dir):
+        abort(404)
+    return series_indexes.get(dicom_dir)
+
+# Link ingested series to the patient as MedicalImage rows, series already linked are skipped
+def save_series_images(patient_id, summaries):
+    if USE_ORM:
+        existing = {image.series_uid for image in MedicalImage.query.filter_by(patient_id=patient_id).all()}
+        for summary in summaries:
+            if summary['series_uid'] not in existing:
+                db.session.add(MedicalImage(patient_id=patient_id, type=series_image_type(summary),
+                                            date_acquired=summary['date_acquired'], series_uid=summary['series_uid']))
+        db.session.commit()
+    else:
+        # runs outside of a request, so it checks out its own pooled connection
+        connection = cnxpool.get_connection()
+        try:
+            cursor = connection.cursor()
+            cursor.execute("SELECT series_uid FROM MedicalImage WHERE patient_id = %s", (patient_id,))
+            existing = {row[0] for row in cursor.fetchall()}
+            query = "INSERT INTO MedicalImage (patient_id, type, date_acquired, series_uid) VALUES (%s, %s, %s, %s)"
+            values = [(patient_id, series_image_type(summary), summary['date_acquired'], summary['series_uid'])
+                      for summary in summaries if summary['series_uid'] not in existing]
+            if values:
+                cursor.executemany(query, values)
+            connection.commit()
+            cursor.close()
+        finally:
+            connection.close()
+    patient_cache.invalidate(patient_id)
+
+# MedicalImage type shown for an ingested series, e.g. "CT - Abdomen 5mm"
+def series_image_type(summary):
+    return ' - '.join(part for part in (summary['modality'], summary['description']) if part)[:100] or 'DICOM'
+
+# Content address of a rendered slice: everything that changes its bytes
+def slice_key(index, version, slice_index, window, factor, encoder):
+    return render_key(index.dicom_dir, version, slice_index, window, factor, encoder.key)
+
+# Encoded image of one slice, served from the render cache when it was rendered before
+def rendered_slice(index, version, slices, slice_index, window, factor, encoder):
+    key = slice_key(index, version, slice_index, window, factor, encoder)
+
+    def render():
+        # the whole series is decoded once in index order and kept in memory
+        with metrics.dicom_stage_seconds.time('load'):
+            hu_slice = volume_cache.get_slice(index, slice_index)
+        with metrics.dicom_stage_seconds.time('window'):
+            center, width = display_window(window, index, slices[slice_index], hu_slice)
+            image = render_slice(downsample(hu_slice, factor), center, width)
+        with metrics.dicom_stage_seconds.time('encode'):
+            return encoder.encode(image)
+
+    return render_cache.get_or_render(key, render)
+
+# Image URLs pinned to the current series version with "v" never change and may be cached
+# for good, any other URL has to be revalidated with its ETag
+def cache_headers(response, etag, version):
+    response.set_etag(etag)
+    # image formats are negotiated from the Accept header
+    response.vary.add('Accept')
+    if request.args.get('v') == version:
+        response.headers['Cache-Control'] = 'public, max-age=31536000, immutable'
+    else:
+        response.headers['Cache-Control'] = 'no-cache'
+    return response
+
+# 304 response when the client already holds the representation, checked before any DICOM work
+def not_modified(etag, version):
+    if request.if_none_match.contains_weak(etag):
+        return cache_headers(Response(status=304), etag, version)
+    return None
+
+# Cached image response for a render key; render() is only called on a cache miss
+def image_response(key, version, render, encoder):
+    cached = not_modified(key, version)
+    if cached is not None:
+        return cached
+    return cache_headers(Response(render_cache.get_or_render(key, render), mimetype=encoder.mimetype), key, version)
+
+# Validate a [start, stop) slice range against the series
+def slice_range(slices, start, stop):
+    if start < 0 or stop > len(slices) or start >= stop or stop - start > app.config['MAX_SLICE_RANGE']:
+        abort(400)
+    return range(start, stop)
+
+# Tile layout of a sprite atlas holding `count` slices
+def atlas_columns(count):
+    return math.ceil(math.sqrt(count))
+
+# columns the patient list can be sorted by, ties are broken by id
+PATIENT_SORT_COLUMNS = ('name', 'date_of_birth', 'id')
+
+# Filters, sort order and keyset position of the patient list from the query string. The position
+# is the sort value and id of the last patient of the previous page ("after", "after_id")
+def patient_list_args(args):
+    sort = args.get('sort', 'name')
+    if sort not in PATIENT_SORT_COLUMNS:
+        abort(400)
+    listing = {
+        'sort': sort,
+        'order': 'desc' if args.get('order') == 'desc' else 'asc',
+        'diagnosis': args.get('diagnosis') or None,
+        'dob_from': date_from_args(args, 'dob_from'),
+        'dob_to': date_from_args(args, 'dob_to'),
+        'after': None,
+        'after_id': args.get('after_id', type=int),
+    }
+    if listing['after_id'] is not None:
+        after = args.get('after', '')
+        try:
+            if sort == 'date_of_birth':
+                after = datetime.strptime(after, '%Y-%m-%d').date()
+            elif sort == 'id':
+                after = int(after)
+        except ValueError:
+            abort(400)
+        listing['after'] = after
+    return listing
+
+# Optional YYYY-MM-DD query parameter
+def date_from_args(args, name):
+    value = args.get(name)
+    if not value:
+        return None
+    try:
+        return datetime.strptime(value, '%Y-%m-%d').date()
+    except ValueError:
+        abort(400)
+
+# Query string of the page following `last`
+def patient_page_args(listing, last):
+    after = getattr(last, listing['sort'])
+    page_args = {key: value for key, value in listing.items() if value is not None}
+    page_args.update(after=after.isoformat() if hasattr(after, 'isoformat') else after, after_id=last.id)
+    return page_args
+
+# Up to `limit` patients of the list described by patient_list_args(), as (patient, series_uid) pairs
+# where series_uid is the latest ingested series of the patient or None. The keyset condition
+# (sort value, id) > (after, after_id) lets the database seek in the sort index instead of
+# counting past an offset, so every page costs the same
+def query_patients(listing, limit):
+    sort = listing['sort']
+    descending = listing['order'] == 'desc'
+
+    if USE_ORM:
+        column = getattr(Patient, sort)
+        # same order as PatientAggregate.series_images
+        latest_series = (select(MedicalImage.series_uid)
+                         .where(MedicalImage.patient_id == Patient.id, MedicalImage.series_uid.isnot(None))
+                         .order_by(MedicalImage.date_acquired.desc(), MedicalImage.id)
+                         .limit(1).scalar_subquery())
+        query = db.session.query(Patient, latest_series)
+        if listing['diagnosis']:
+            query = query.filter(Patient.diagnosis == listing['diagnosis'])
+        if listing['dob_from']:
+            query = query.filter(Patient.date_of_birth >= listing['dob_from'])
+        if listing['dob_to']:
+            query = query.filter(Patient.date_of_birth <= listing['dob_to'])
+        if listing['after_id'] is not None:
+            if sort == 'id':
+                query = query.filter(Patient.id < listing['after_id'] if descending else Patient.id > listing['after_id'])
+            elif descending:
+                query = query.filter(or_(column < listing['after'],
+                                         and_(column == listing['after'], Patient.id < listing['after_id'])))
+            else:
+                query = query.filter(or_(column > listing['after'],
+                                         and_(column == listing['after'], Patient.id > listing['after_id'])))
+        order = [column.desc() if descending else column.asc()]
+        if sort != 'id':
+            order.append(Patient.id.desc() if descending else Patient.id.asc())
+        return [(patient, series_uid) for patient, series_uid in query.order_by(*order).limit(limit)]
+
+    conditions, values = [], []
+    if listing['diagnosis']:
+        conditions.append("diagnosis = %s")
+        values.append(listing['diagnosis'])
+    if listing['dob_from']:
+        conditions.append("date_of_birth >= %s")
+        values.append(listing['dob_from'])
+    if listing['dob_to']:
+        conditions.append("date_of_birth <= %s")
+        values.append(listing['dob_to'])
+    if listing['after_id'] is not None:
+        # sort is one of PATIENT_SORT_COLUMNS, never user text
+        op = '<' if descending else '>'
+        if sort == 'id':
+            conditions.append(f"id {op} %s")
+            values.append(listing['after_id'])
+        else:
+            # expanded form of the row comparison, which MySQL turns into an index range
+            conditions.append(f"({sort} {op} %s OR ({sort} = %s AND id {op} %s))")
+            values.extend([listing['after'], listing['after'], listing['after_id']])
+    direction = 'DESC' if descending else 'ASC'
+    order = f"{sort} {direction}" if sort == 'id' else f"{sort} {direction}, id {direction}"
+    where = " WHERE " + " AND ".join(conditions) if conditions else ""
+
+    cursor = get_db().cursor(dictionary=True)
+    # the latest series of every listed patient, same order as PatientAggregate.series_images
+    query = (f"SELECT id, name, date_of_birth, diagnosis, "
+             f"(SELECT series_uid FROM MedicalImage WHERE patient_id = Patient.id AND series_uid IS NOT NULL "
+             f"ORDER BY date_acquired DESC, id LIMIT 1) AS series_uid "
+             f"FROM Patient{where} ORDER BY {order} LIMIT %s")
+    cursor.execute(query, (*values, limit))
+    patients = [(PatientObj(row['id'], row['name'], row['date_of_birth'], row['diagnosis']), row['series_uid'])
+                for row in cursor]
+    cursor.close()
+    return patients
+
+# Image response of an intensity projection of a series. Projections are computed once per
+# series version (at ingest, or on first view of older series) and read from the volume store
+def projection_response(index, kind, window, factor, encoder):
+    version, slices = index.snapshot()
+    if not slices:
+        abort(404)
+    key = render_key(index.dicom_dir, version, 'projection', kind, window, factor, encoder.key)
+
+    def render():
+        stack = volume_store.projections(index, lambda: volume_cache.get_volume(index))
+        plane = stack[PROJECTIONS.index(kind)]
+        center, width = display_window(window, index, slices[0], plane)
+        return encoder.encode(render_slice(downsample(plane, factor), center, width))
+
+    return image_response(key, version, render, encoder)
+
+# URL of the thumbnail of a patient's latest series, None for patients without imaging. The URL is pinned
+# to the version the series projections were stored for, so browsers cache it for good; series whose
+# projections are not stored yet get an unpinned URL that is revalidated. Only the small sidecar file of
+# the projections is read: neither the database, the series folder nor its index is touched
+def thumbnail_url(patient_id, series_uid):
+    if not series_uid:
+        return None
+    try:
+        dicom_dir = patient_series_dir(app.config['DICOM_STORAGE_DIR'], patient_id, series_uid)
+    except ValueError:
+        return None
+    version = volume_store.stored_version(dicom_dir, 'projections')
+    args = {'v': version} if version else {}
+    return url_for('view_ct_thumbnail', patient=patient_id, series=series_uid, **args)
+
+# Downsampling factor of a series thumbnail
+def thumbnail_factor(index):
+    _, slices = index.snapshot()
+    if not slices:
+        abort(404)
+    return max(math.ceil(max(slices[0]['rows'], slices[0]['columns']) / app.config['THUMBNAIL_SIZE']), 1)
+
+# Home page: one keyset-paginated page of patients, filtered and sorted in SQL
+@app.route('/')
+def home():
+    # the typeahead of this page needs the search index, start building it in the background. It is
+    # not built at import, so a master process preloading the app opens no database connection
+    search_index.build_in_background()
+    listing = patient_list_args(request.args)
+    page_size = app.config['PATIENT_PAGE_SIZE']
+    # one extra row tells whether there is a next page
+    rows = query_patients(listing, page_size + 1)
+    patients = [patient for patient, _ in rows]
+    next_args = None
+    if len(patients) > page_size:
+        patients = patients[:page_size]
+        next_args = patient_page_args(listing, patients[-1])
+    thumbnails = {patient.id: thumbnail_url(patient.id, series_uid) for patient, series_uid in rows[:page_size]}
+    # query string of the first page with the same filters and sort order
+    first_args = {key: value for key, value in listing.items()
+                  if value is not None and key not in ('after', 'after_id')}
+    if first_args == {'sort': 'name', 'order': 'asc'}:
+        first_args = {}
+
+    return render_template('home.html', patients=patients, thumbnails=thumbnails, diagnoses=diagnosis_table.get(),
+                           listing=listing, first_args=first_args, next_args=next_args,
+                           sort_columns=PATIENT_SORT_COLUMNS)
 
 # Basic "About radiotherapy" page
 @app.route('/radiotherapy')
 def radiotherapy():
     return render_template('radiotherapy.html')
 
-# Create Patient page
-@app.route('/create_patient', methods=['GET', 'POST'])
-def create_patient():
+# A patient and all of its child rows in one round trip: one UNION ALL query whose rows are tagged
+# with their kind, columns (kind, id, name, day, dose, fractionation, detail, series_uid)
+PATIENT_AGGREGATE_QUERY = """
+    SELECT 'patient' AS kind, id, name, date_of_birth AS day, NULL AS dose, NULL AS fractionation,
+           diagnosis AS detail, NULL AS series_uid FROM Patient WHERE id = %(id)s
+    UNION ALL
+    SELECT 'plan', id, name, NULL, dose, fractionation, NULL, NULL FROM TreatmentPlan WHERE patient_id = %(id)s
+    UNION ALL
+    SELECT 'machine', id, name, NULL, NULL, NULL, energy, NULL FROM TreatmentMachine WHERE patient_id = %(id)s
+    UNION ALL
+    SELECT 'image', id, type, date_acquired, NULL, NULL, NULL, series_uid FROM MedicalImage WHERE patient_id = %(id)s
+    ORDER BY id
+"""
+
+# The same query built with SQLAlchemy for USE_ORM mode
+def patient_aggregate_select(patient_id):
+    return union_all(
+        select(literal('patient').label('kind'), Patient.id, Patient.name, Patient.date_of_birth.label('day'),
+               null().label('dose'), null().label('fractionation'), Patient.diagnosis.label('detail'),
+               null().label('series_uid')).where(Patient.id == patient_id),
+        select(literal('plan'), TreatmentPlan.id, TreatmentPlan.name, null(), TreatmentPlan.dose,
+               TreatmentPlan.fractionation, null(), null()).where(TreatmentPlan.patient_id == patient_id),
+        select(literal('machine'), TreatmentMachine.id, TreatmentMachine.name, null(), null(), null(),
+               TreatmentMachine.energy, null()).where(TreatmentMachine.patient_id == patient_id),
+        select(literal('image'), MedicalImage.id, MedicalImage.type, MedicalImage.date_acquired, null(), null(), null(),
+               MedicalImage.series_uid).where(MedicalImage.patient_id == patient_id),
+    ).order_by('id')
 
-    # Get all diagnoses from the database
+# Whether a patient row exists, a primary key lookup that reads no other table
+def patient_exists(patient_id):
     if USE_ORM:
-        diagnoses = Diagnosis.query.all()
+        return db.session.query(Patient.query.filter_by(id=patient_id).exists()).scalar()
+    cursor = get_db().cursor()
+    cursor.execute("SELECT 1 FROM Patient WHERE id = %s", (patient_id,))
+    found = cursor.fetchone() is not None
+    cursor.close()
+    return found
+
+# Load a patient aggregate from the database, None when the patient does not exist
+def load_patient_aggregate(patient_id):
+    if USE_ORM:
+        rows = db.session.execute(patient_aggregate_select(patient_id)).all()
     else:
-        cursor = g.db.cursor(dictionary=True)
-        query = "SELECT id, name FROM Diagnosis"
-        cursor.execute(query)
-        diagnoses = []
-        for row in cursor:
-            diagnosis = DiagnosisObj(row['id'], row['name'])
-            diagnoses.append(diagnosis)
+        cursor = get_db().cursor()
+        cursor.execute(PATIENT_AGGREGATE_QUERY, {'id': patient_id})
+        rows = cursor.fetchall()
+        cursor.close()
+
+    patient, plans, machine, images = None, [], None, []
+    for kind, row_id, name, day, dose, fractionation, detail, series_uid in rows:
+        if kind == 'patient':
+            patient = PatientObj(row_id, name, day, detail)
+        elif kind == 'plan':
+            plans.append(TreatmentPlanObj(row_id, patient_id, name, dose, fractionation))
+        elif kind == 'machine':
+            machine = machine or TreatmentMachineObj(row_id, patient_id, name, detail)
+        else:
+            images.append(MedicalImageObj(row_id, patient_id, name, day, series_uid))
+    if patient is None:
+        return None
+    return PatientAggregate(patient, plans, machine, images)
+
+# Patient aggregate for the read-only pages, served from the read-through cache
+def patient_aggregate(patient_id):
+    return patient_cache.get(patient_id, lambda: load_patient_aggregate(patient_id))
+
+# Treatment plans of the patient form as (name, dose, fractionation) rows
+def plans_from_form(form):
+    try:
+        return [(name, float(dose), float(fractionation)) for name, dose, fractionation in
+                zip(form.getlist("plan_name[]"), form.getlist("plan_dose[]"), form.getlist("plan_fractionation[]"))]
+    except ValueError:
+        abort(400)
+
+# Medical images of the patient form as (type, date acquired) rows
+def images_from_form(form):
+    try:
+        return [(image_type, datetime.strptime(date_acquired, '%Y-%m-%d').date()) for image_type, date_acquired in
+                zip(form.getlist("image_type[]"), form.getlist("image_date_acquired[]"))]
+    except ValueError:
+        abort(400)
 
+# Pair submitted form rows with the existing (id, values) rows by position. Returns the
+# (*values, id) rows that changed, the new rows and the (id,) rows no longer submitted
+def diff_rows(existing, submitted):
+    updates = [(*values, row_id) for (row_id, current), values in zip(existing, submitted) if current != values]
+    inserts = submitted[len(existing):]
+    deletes = [(row_id,) for row_id, _ in existing[len(submitted):]]
+    return updates, inserts, deletes
+
+# Insert a patient with its plans, images and machine in one transaction and return its id.
+# Child rows go in as multi-row INSERTs (executemany), and the single commit is the only fsync
+def insert_patient(connection, name, date_of_birth, diagnosis, plans, images, machine):
+    cursor = connection.cursor()
+    try:
+        query = "INSERT INTO Patient (name, date_of_birth, diagnosis) VALUES (%s, %s, %s)"
+        cursor.execute(query, (name, date_of_birth, diagnosis))
+        patient_id = cursor.lastrowid
+
+        if plans:
+            query = "INSERT INTO TreatmentPlan (patient_id, name, dose, fractionation) VALUES (%s, %s, %s, %s)"
+            cursor.executemany(query, [(patient_id, *plan) for plan in plans])
+        if images:
+            query = "INSERT INTO MedicalImage (patient_id, type, date_acquired) VALUES (%s, %s, %s)"
+            cursor.executemany(query, [(patient_id, *image) for image in images])
+        query = "INSERT INTO TreatmentMachine (patient_id, name, energy) VALUES (%s, %s, %s)"
+        cursor.execute(query, (patient_id, *machine))
+
+        connection.commit()
+        return patient_id
+    except Exception:
+        connection.rollback()
+        raise
+    finally:
+        cursor.close()
+
+# Apply an edit form to a patient in one transaction, touching only the rows whose values changed
+def update_patient(connection, patient, existing_plans, existing_images, treatment_machine, name, date_of_birth,
+                   diagnosis, plans, images, machine):
+    cursor = connection.cursor()
+    try:
+        if (patient.name, patient.date_of_birth, patient.diagnosis) != (name, date_of_birth, diagnosis):
+            query = "UPDATE Patient SET name = %s, date_of_birth = %s, diagnosis = %s WHERE id = %s"
+            cursor.execute(query, (name, date_of_birth, diagnosis, patient.id))
+
+        updates, inserts, deletes = diff_rows(
+            [(plan.id, (plan.name, plan.dose, plan.fractionation)) for plan in existing_plans], plans)
+        if updates:
+            cursor.executemany("UPDATE TreatmentPlan SET name = %s, dose = %s, fractionation = %s WHERE id = %s", updates)
+        if inserts:
+            query = "INSERT INTO TreatmentPlan (patient_id, name, dose, fractionation) VALUES (%s, %s, %s, %s)"
+            cursor.executemany(query, [(patient.id, *plan) for plan in inserts])
+        if deletes:
+            cursor.executemany("DELETE FROM TreatmentPlan WHERE id = %s", deletes)
+
+        if treatment_machine is None:
+            query = "INSERT INTO TreatmentMachine (patient_id, name, energy) VALUES (%s, %s, %s)"
+            cursor.execute(query, (patient.id, *machine))
+        elif (treatment_machine.name, treatment_machine.energy) != machine:
+            cursor.execute("UPDATE TreatmentMachine SET name = %s, energy = %s WHERE id = %s",
+                           (*machine, treatment_machine.id))
+
+        updates, inserts, deletes = diff_rows(
+            [(image.id, (image.type, image.date_acquired)) for image in existing_images], images)
+        if updates:
+            cursor.executemany("UPDATE MedicalImage SET type = %s, date_acquired = %s WHERE id = %s", updates)
+        if inserts:
+            query = "INSERT INTO MedicalImage (patient_id, type, date_acquired) VALUES (%s, %s, %s)"
+            cursor.executemany(query, [(patient.id, *image) for image in inserts])
+        if deletes:
+            cursor.executemany("DELETE FROM MedicalImage WHERE id = %s", deletes)
+
+        connection.commit()
+    except Exception:
+        connection.rollback()
+        raise
+    finally:
         cursor.close()
-    
+
+# Create Patient page
+@app.route('/create_patient', methods=['GET', 'POST'])
+def create_patient():
     # submit button clicked
     if request.method == "POST":
 
         # get all form fields
         patient_name = request.form["patient_name"]
-        patient_dob = datetime.strptime(request.form["patient_dob"], '%Y-%m-%d')
+        patient_dob = datetime.strptime(request.form["patient_dob"], '%Y-%m-%d').date()
         patient_diagnosis = request.form["patient_diagnosis"]
-        treatment_plan_names = request.form.getlist("plan_name[]")
-        treatment_plan_doses = request.form.getlist("plan_dose[]")
-        treatment_plan_fractions = request.form.getlist("plan_fractionation[]")
-        machine_name = request.form["machine_name"]
-        machine_energy = request.form["machine_energy"]
-        medical_image_types = request.form.getlist("image_type[]")
-        medical_image_dates = request.form.getlist("image_date_acquired[]")
+        plans = plans_from_form(request.form)
+        images = images_from_form(request.form)
+        machine = (request.form["machine_name"], request.form["machine_energy"])
 
         if USE_ORM:
+            # the patient and its rows are written in a single transaction, flush() assigns the patient id
             patient = Patient(name=patient_name, date_of_birth=patient_dob, diagnosis=patient_diagnosis)
             db.session.add(patient)
-            db.session.commit() # save changes to allow retrieval of patient id
-
-            # Create treatment plan objects
-            for i in range(len(treatment_plan_names)):
-                treatment_plan = TreatmentPlan(patient_id=patient.id, name=treatment_plan_names[i], dose=treatment_plan_doses[i], fractionation=treatment_plan_fractions[i])
-                db.session.add(treatment_plan)
-
-            # Create medical image objects
-            for i in range(len(medical_image_types)):
-                medical_image = MedicalImage(patient_id=patient.id, type=medical_image_types[i], date_acquired=datetime.strptime(medical_image_dates[i], '%Y-%m-%d'))
-                db.session.add(medical_image)
-
-            # Create treatment machine object
-            treatment_machine = TreatmentMachine(patient_id=patient.id, name=machine_name, energy=machine_energy)
-            db.session.add(treatment_machine)
+            db.session.flush()
+            patient_id = patient.id
 
+            db.session.add_all([TreatmentPlan(patient_id=patient_id, name=name, dose=dose, fractionation=fractionation)
+                                for name, dose, fractionation in plans])
+            db.session.add_all([MedicalImage(patient_id=patient_id, type=image_type, date_acquired=date_acquired)
+                                for image_type, date_acquired in images])
+            db.session.add(TreatmentMachine(patient_id=patient_id, name=machine[0], energy=machine[1]))
             db.session.commit()
         else:
-            cursor = g.db.cursor(dictionary=True)
-
-            # Create patient object
-            query = "INSERT INTO Patient (name, date_of_birth, diagnosis) VALUES (%s, %s, %s)"
-            values = (patient_name, patient_dob, patient_diagnosis)
-            cursor.execute(query, values)
-            g.db.commit()
-
-            # Get the patient id of the newly created patient
-            patient_id = cursor.lastrowid
-
-            # Create treatment plan objects
-            for i in range(len(treatment_plan_names)):
-                query = "INSERT INTO TreatmentPlan (patient_id, name, dose, fractionation) VALUES (%s, %s, %s, %s)"
-                values = (patient_id, treatment_plan_names[i], treatment_plan_doses[i], treatment_plan_fractions[i])
-                cursor.execute(query, values)
-
-            # Create medical image objects
-            for i in range(len(medical_image_types)):
-                query = "INSERT INTO MedicalImage (patient_id, type, date_acquired) VALUES (%s, %s, %s)"
-                values = (patient_id, medical_image_types[i], datetime.strptime(medical_image_dates[i], '%Y-%m-%d'))
-                cursor.execute(query, values)
-
-            # Create treatment machine object
-            query = "INSERT INTO TreatmentMachine (patient_id, name, energy) VALUES (%s, %s, %s)"
-            values = (patient_id, machine_name, machine_energy)
-            cursor.execute(query, values)
-
-            g.db.commit()
-            cursor.close()
+            patient_id = insert_patient(get_db(), patient_name, patient_dob, patient_diagnosis, plans, images, machine)
 
+        machine_table.invalidate()
+        search_index.add(patient_id, patient_name, patient_diagnosis)
         return redirect(url_for("home")) # go back home on submission
-    return render_template("create_patient.html", diagnoses=diagnoses)
+
+    # lookup data comes from the process-wide reference tables
+    return render_template("create_patient.html", diagnoses=diagnosis_table.get(), machine_options=machine_table.get())
 
 # Update/Edit Patient page
 @app.route('/edit_patient/<int:id>', methods=['GET', 'POST'])
 def edit_patient(id):
-    if USE_ORM:
-        patient = Patient.query.get(id)
-        diagnoses = Diagnosis.query.all()
-        # Get the existing treatment plans for this patient
-        existing_plans = TreatmentPlan.query.filter_by(patient_id=id).all()
-        existing_plan_ids = [plan.id for plan in existing_plans]
-
-        treatment_machine = TreatmentMachine.query.filter_by(patient_id=id).first()
-
-        # Get the existing treatment plans for this patient
-        existing_images = MedicalImage.query.filter_by(patient_id=id).all()
-        existing_image_ids = [image.id for image in existing_images]
-    else:
-        cursor = g.db.cursor(dictionary=True)
-        query = "SELECT * FROM Patient WHERE id = %s"
-        values = (id,)
-        cursor.execute(query, values)
-        result = cursor.fetchone()
-        patient = PatientObj(**result)
-
-        query = "SELECT id, name FROM Diagnosis"
-        cursor.execute(query)
-        diagnoses = []
-        for row in cursor:
-            diagnosis = DiagnosisObj(row['id'], row['name'])
-            diagnoses.append(diagnosis)
-
-        query = "SELECT * FROM TreatmentPlan WHERE patient_id = %s"
-        values = (id,)
-        cursor.execute(query, values)
-        existing_plans = []
-        existing_plan_ids = []
-        for row in cursor:
-            plan = TreatmentPlanObj(**row)
-            existing_plans.append(plan)
-            existing_plan_ids.append(plan.id)
-
-        query = "SELECT * FROM TreatmentMachine WHERE patient_id = %s"
-        values = (id,)
-        cursor.execute(query, values)
-        result = cursor.fetchone()
-        treatment_machine = TreatmentMachineObj(**result)
-
-        query = "SELECT * FROM MedicalImage WHERE patient_id = %s"
-        values = (id,)
-        cursor.execute(query, values)
-        existing_images = []
-        existing_image_ids = []
-        for row in cursor:
-            image = MedicalImageObj(**row)
-            existing_images.append(image)
-            existing_image_ids.append(image.id)
-        
-        cursor.close()
-
     # submit button clicked
     if request.method == 'POST':
+        name = request.form['patient_name']
+        date_of_birth = datetime.strptime(request.form['patient_dob'], '%Y-%m-%d').date()
+        diagnosis = request.form['patient_diagnosis']
+        plans = plans_from_form(request.form)
+        images = images_from_form(request.form)
+        machine = (request.form.get("machine_name"), request.form.get("machine_energy"))
 
         if USE_ORM:
-            # get all form fields and update each patient object parameter
-            patient.name = request.form['patient_name']
-            patient.date_of_birth = datetime.strptime(request.form['patient_dob'], '%Y-%m-%d')
-            patient.diagnosis = request.form['patient_diagnosis']
-            db.session.commit()
-            
-            treatment_plan_names = request.form.getlist("plan_name[]")
-            treatment_plan_doses = request.form.getlist("plan_dose[]")
-            treatment_plan_fractions = request.form.getlist("plan_fractionation[]")
-
-            # Update existing plans
-            for i, plan in enumerate(existing_plans):
-                plan.plan_name = treatment_plan_names[i]
-                plan.dose = treatment_plan_doses[i]
-                plan.fractionation = treatment_plan_fractions[i]
-        
-            # Add new plans
-            for i in range(len(existing_plans), len(treatment_plan_names)):
-                new_plan = TreatmentPlan(
-                    name=treatment_plan_names[i], dose=treatment_plan_doses[i], fractionation=treatment_plan_fractions[i], patient_id=patient.id
-                )
-                db.session.add(new_plan)
-
-            # Remove plans that were deleted from the form
-            for plan in existing_plans:
-                if plan.id not in existing_plan_ids:
-                    db.session.delete(plan)
-            
-            # Update the treatment machine information
-            treatment_machine.name = request.form.get("machine_name")
-            treatment_machine.energy = request.form.get("machine_energy")
-
-            # Create medical image objects and overwrite old image info
-            medical_image_types = request.form.getlist("image_type[]")
-            medical_image_dates = request.form.getlist("image_date_acquired[]")
-
-            # Update existing images
-            for i, image in enumerate(existing_images):
-                image.type = medical_image_types[i]
-                image.date_acquired = datetime.strptime(medical_image_dates[i], '%Y-%m-%d')
-        
-            # Add new images
-            for i in range(len(existing_images), len(medical_image_types)):
-                new_image = MedicalImage(
-                    type=medical_image_types[i], date_acquired=datetime.strptime(medical_image_dates[i], '%Y-%m-%d'), patient_id=patient.id
-                )
-                db.session.add(new_image)
-
-            # Remove plans that were deleted from the form
-            for image in existing_images:
-                if image.id not in existing_image_ids:
-                    db.session.delete(image)
+            # the rows being changed are loaded into the session, ordered the way the form lists them
+            patient = Patient.query.get(id)
+            if patient is None:
+                abort(404)
+            existing_plans = TreatmentPlan.query.filter_by(patient_id=id).order_by(TreatmentPlan.id).all()
+            treatment_machine = TreatmentMachine.query.filter_by(patient_id=id).first()
+            existing_images = MedicalImage.query.filter_by(patient_id=id).order_by(MedicalImage.id).all()
+
+            # the session only emits UPDATEs for attributes whose value changed,
+            # everything is written by the single commit at the end
+            patient.name = name
+            patient.date_of_birth = date_of_birth
+            patient.diagnosis = diagnosis
+
+            # form rows are paired with the existing rows by position
+            for plan, (plan_name, dose, fractionation) in zip(existing_plans, plans):
+                plan.name = plan_name
+                plan.dose = dose
+                plan.fractionation = fractionation
+            for plan_name, dose, fractionation in plans[len(existing_plans):]:
+                db.session.add(TreatmentPlan(patient_id=id, name=plan_name, dose=dose, fractionation=fractionation))
+            for plan in existing_plans[len(plans):]:
+                db.session.delete(plan)
+
+            if treatment_machine is None:
+                db.session.add(TreatmentMachine(patient_id=id, name=machine[0], energy=machine[1]))
+            else:
+                treatment_machine.name, treatment_machine.energy = machine
+
+            for image, (image_type, date_acquired) in zip(existing_images, images):
+                image.type = image_type
+                image.date_acquired = date_acquired
+            for image_type, date_acquired in images[len(existing_images):]:
+                db.session.add(MedicalImage(patient_id=id, type=image_type, date_acquired=date_acquired))
+            for image in existing_images[len(images):]:
+                db.session.delete(image)
 
             db.session.commit() # save all changes
         else:
-            # get all form fields and update each patient object parameter
-            cursor = g.db.cursor()
-            query = "UPDATE Patient SET name = %s, date_of_birth = %s, diagnosis = %s WHERE id = %s"
-            values = (request.form['patient_name'], request.form['patient_dob'], request.form['patient_diagnosis'], id)
-            cursor.execute(query, values)
-            g.db.commit()
-
-            # Update treatment plans
-            treatment_plan_names = request.form.getlist("plan_name[]")
-            treatment_plan_doses = request.form.getlist("plan_dose[]")
-            treatment_plan_fractions = request.form.getlist("plan_fractionation[]")
-
-            # Update existing plans
-            for i, plan_id in enumerate(existing_plan_ids):
-                query = "UPDATE TreatmentPlan SET name = %s, dose = %s, fractionation = %s WHERE id = %s"
-                values = (treatment_plan_names[i], treatment_plan_doses[i], treatment_plan_fractions[i], plan_id)
-                cursor.execute(query, values)
-                g.db.commit()
-
-            # Add new plans
-            for i in range(len(existing_plan_ids), len(treatment_plan_names)):
-                query = "INSERT INTO TreatmentPlan (plan_name, dose, fractionation, patient_id) VALUES (%s, %s, %s, %s)"
-                values = (treatment_plan_names[i], treatment_plan_doses[i], treatment_plan_fractions[i], id)
-                cursor.execute(query, values)
-                g.db.commit()
-
-            # Remove plans that were deleted from the form
-            for plan in existing_plans:
-                if plan.id not in existing_plan_ids:
-                    query = "DELETE FROM TreatmentPlan WHERE id = %s"
-                    values = (plan.id,)
-                    cursor.execute(query, values)
-                    g.db.commit()
-
-            # Update the treatment machine information
-            query = "UPDATE TreatmentMachine SET name = %s, energy = %s WHERE patient_id = %s"
-            values = (request.form.get("machine_name"), request.form.get("machine_energy"), id)
-            cursor.execute(query, values)
-            g.db.commit()
-
-            # Update medical images
-            medical_image_types = request.form.getlist("image_type[]")
-            medical_image_dates = request.form.getlist("image_date_acquired[]")
-
-            # Update existing images
-            for i, image_id in enumerate(existing_image_ids):
-                query = "UPDATE MedicalImage SET type = %s, date_acquired = %s WHERE id = %s"
-                values = (medical_image_types[i], medical_image_dates[i], image_id)
-                cursor.execute(query, values)
-                g.db.commit()
-            
-            # Add new images
-            for i in range(len(existing_image_ids), len(medical_image_types)):
-                query = "INSERT INTO MedicalImage (type, date_acquired, patient_id) VALUES (%s, %s, %s)"
-                values = (medical_image_types[i], medical_image_dates[i], id)
-                cursor.execute(query, values)
-                g.db.commit()
-
-            # Remove images that were deleted from the form
-            for image in existing_images:
-                if image.id not in existing_image_ids:
-                    query = "DELETE FROM MedicalImage WHERE id = %s"
-                    values = (image.id,)
-                    cursor.execute(query, values)
-                    g.db.commit()
+            # changes are diffed against the current rows, never against a cached copy
+            current = load_patient_aggregate(id)
+            if current is None:
+                abort(404)
+            update_patient(get_db(), current.patient, current.plans, current.images, current.machine, name, date_of_birth,
+                           diagnosis, plans, images, machine)
 
+        patient_cache.invalidate(id)
+        machine_table.invalidate()
+        search_index.add(id, name, diagnosis)
         return redirect(url_for('home')) # redirect home after submission
-    return render_template('update_patient.html', patient=patient, diagnoses=diagnoses, treatment_plans=existing_plans, treatment_machine=treatment_machine, medical_images=existing_images)
+
+    aggregate = patient_aggregate(id)
+    if aggregate is None:
+        abort(404)
+    return render_template('update_patient.html', patient=aggregate.patient, diagnoses=diagnosis_table.get(),
+                           machine_options=machine_table.get(), treatment_plans=aggregate.plans,
+                           treatment_machine=aggregate.machine, medical_images=aggregate.images)
 
 # Remove patient API
 @app.route("/remove_patient/<int:id>")
@@ -352,55 +848,434 @@ def remove_patient(id):
         db.session.commit()
     else:
         # remove patient from database
-        cursor = g.db.cursor()
+        cursor = get_db().cursor()
         query = "DELETE FROM patient WHERE id = %s"
         cursor.execute(query, (id,))
-        g.db.commit()
+        get_db().commit()
         cursor.close()
 
+    patient_cache.invalidate(id)
+    search_index.remove(id)
     return redirect(url_for("home"))
 
+# Patient search API behind the home page typeahead: patients whose name or diagnosis
+# contains every word of "q", answered from the in-process trigram index
+@app.route("/search_patients")
+def search_patients():
+    limit = min(request.args.get('limit', 10, type=int), 50)
+    if limit <= 0:
+        abort(400)
+    results = search_index.search(request.args.get('q', ''), limit)
+    return jsonify({'results': [
+        {'id': patient_id, 'name': name, 'diagnosis': diagnosis, 'url': url_for('view_patient', id=patient_id)}
+        for patient_id, name, diagnosis in results
+    ]})
+
+# Metrics of this worker process in the Prometheus text format
+@app.route("/metrics")
+def export_metrics():
+    return Response(metrics.registry.render(), content_type='text/plain; version=0.0.4; charset=utf-8')
+
+# Connection pool state and checkout wait counters of this worker process
+@app.route("/pool_stats")
+def pool_stats():
+    return jsonify(cnxpool.stats())
+
 # View Patient page
 @app.route('/view_patient/<int:id>')
 def view_patient(id):
-    if USE_ORM:
-        patient = Patient.query.get(id)
+    aggregate = patient_aggregate(id)
+    if aggregate is None:
+        abort(404)
+    patient = aggregate.patient
+    # ingested DICOM series of the patient, most recent first
+    series_images = aggregate.series_images
+
+    # show the requested series, else the latest one, else the bundled sample series
+    series_uid = request.args.get('series')
+    if series_uid not in [image.series_uid for image in series_images]:
+        series_uid = series_images[0].series_uid if series_images else None
+    series_args = {'patient': id, 'series': series_uid} if series_uid else {}
+
+    # get the number of dicom slices and the slice size from the series index
+    index = series_index(id if series_uid else None, series_uid)
+    version, slices = index.snapshot()
+    # image URLs carry the series version so browsers and proxies can cache them for good
+    series_args['v'] = version
+
+    # open the volume and its statistics in the background so the first slice requests find them ready
+    prefetcher.warm(lambda: volume_store.statistics(index, lambda: volume_cache.get_volume(index)))
+    num_slices = len(slices)
+    rows, columns = (slices[0]['rows'], slices[0]['columns']) if slices else (0, 0)
+
+    # the auto window is offered once the statistics of the series are known
+    window_presets = dict(WINDOW_PRESETS)
+    stats = volume_store.statistics(index)
+    if stats is not None:
+        window_presets['auto'] = stats['auto_window']
+
+    return render_template('view_patient.html', patient=patient, num_slices=num_slices, rows=rows, columns=columns,
+                           window_presets=window_presets, series_images=series_images, series_uid=series_uid,
+                           series_args=series_args, max_slice_range=app.config['MAX_SLICE_RANGE'],
+                           raw_volume=raw_volume_bytes(slices) <= app.config['RAW_VOLUME_MAX_BYTES'])
+
+# Upload DICOM API: a zip or a set of files is staged and ingested in the background
+@app.route('/upload_dicom/<int:id>', methods=['POST'])
+def upload_dicom(id):
+    # series are stored under the patient and linked to it by a foreign key, check it exists before staging anything
+    if not patient_exists(id):
+        abort(404)
+    uploads = [upload for upload in request.files.getlist('dicom_files') if upload.filename]
+    if not uploads:
+        abort(400)
+
+    staging_dir = os.path.join(app.config['DICOM_UPLOAD_DIR'], uuid.uuid4().hex)
+    if len(uploads) == 1 and uploads[0].filename.lower().endswith('.zip'):
+        os.makedirs(staging_dir)
+        source = os.path.join(staging_dir, 'upload.zip')
+        uploads[0].save(source)
     else:
-        # get patient from database
-        cursor = g.db.cursor(dictionary=True)
-        query = "SELECT * FROM patient WHERE id = %s"
-        cursor.execute(query, (id,))
-        result = cursor.fetchone()
-        patient = PatientObj(**result)
-        cursor.close()
-        
-    # get the number of dicom files
-    dicom_dir = BASE_DIR + "/static/dicom"
-    dicom_files = [f for f in os.listdir(dicom_dir) if f.endswith(".dcm")]
-    num_slices = len(dicom_files)
+        # uploaded names are not trusted, files are identified by their SOPInstanceUID later
+        source = os.path.join(staging_dir, 'files')
+        os.makedirs(source)
+        for i, upload in enumerate(uploads):
+            upload.save(os.path.join(source, f"{i}.dcm"))
+
+    # the ingest process opens its own series indexes and volume store on the shared folders
+    args = (source, id, app.config['DICOM_STORAGE_DIR'], staging_dir, series_indexes.index_dir,
+            series_indexes.check_interval, volume_store.store_dir, app.config['INGEST_WORKERS'])
+
+    def save(summaries):
+        with app.app_context():
+            save_series_images(id, summaries)
+
+    job_id = ingest_jobs.submit(ingest_study_process, args, on_done=save, cleanup_dir=staging_dir)
+    return jsonify({'job': job_id, 'status': url_for('ingest_job_status', job_id=job_id)}), 202
+
+# Export API: the patient's ingested series streamed as one zip, de-identified with "deidentify=1"
+@app.route('/export_patient/<int:id>')
+def export_patient(id):
+    # the export reads the current rows, not the cached aggregate
+    aggregate = load_patient_aggregate(id)
+    if aggregate is None:
+        abort(404)
+    series_uids = [image.series_uid for image in aggregate.series_images]
+
+    indexes = []
+    for series_uid in dict.fromkeys(series_uids):
+        dicom_dir = patient_series_dir(app.config['DICOM_STORAGE_DIR'], id, series_uid)
+        if os.path.isdir(dicom_dir):
+            indexes.append((series_uid, series_indexes.get(dicom_dir)))
+    if not indexes:
+        abort(404)
+
+    deidentify = request.args.get('deidentify', 0, type=int) == 1
+
+    def members():
+        # files in slice order, one folder per series
+        for series_uid, index in indexes:
+            for entry in index.get_slices():
+                yield f"{series_uid}/{entry['filename']}", os.path.join(index.dicom_dir, entry['filename'])
+
+    archive = iter_zip(members(), compress=app.config['EXPORT_DEFLATE'],
+                       pseudonym=f"ANON-{uuid.uuid4().hex[:8].upper()}" if deidentify else None)
+    filename = f"patient-{id}{'-deidentified' if deidentify else ''}.zip"
+    return Response(archive, mimetype='application/zip', headers={
+        'Content-Disposition': f'attachment; filename="{filename}"',
+        'Cache-Control': 'no-store',
+        'X-Accel-Buffering': 'no',
+    })
 
-    return render_template('view_patient.html', patient=patient, num_slices=num_slices)
+# Ingest job status API, polled by the viewer after an upload
+@app.route('/ingest_jobs/<job_id>')
+def ingest_job_status(job_id):
+    job = ingest_jobs.status(job_id)
+    if job is None:
+        abort(404)
+    return jsonify(job)
 
 # View dicom slice API
 @app.route("/view_ct_slice/<int:slice_index>")
 def view_ct_slice(slice_index):
-    # paths
-    dicom_dir = BASE_DIR + "/static/dicom"
-    output_dir = BASE_DIR + "/static/dump/converted_dicom"
-
-    # create directory for output and don't complain if it exists
-    os.makedirs(output_dir, exist_ok=True)
-  
-    # Convert dicom files to PNG
-    dicom_files = [f for f in os.listdir(dicom_dir) if f.endswith(".dcm")]
-    dicom_files.sort()
-    dicom_file = os.path.join(dicom_dir, f"{dicom_files[slice_index]}")
-    dicom_data = pydicom.dcmread(dicom_file)
-    image = dicom_data.pixel_array
-    image = Image.fromarray(image)
-    if image.mode != 'RGB':
-        image = image.convert('RGB')
-    image.save(f"{output_dir}/slice_{slice_index}.png") # save location
-
-    # return path for display
-    return send_file(f"{output_dir}/slice_{slice_index}.png", mimetype="image/png")
\ No newline at end of file
+    index = series_index_from_args(request.args)
+    version, slices = index.snapshot()
+    if slice_index < 0 or slice_index >= len(slices):
+        abort(404)
+
+    window = window_from_args(request.args)
+    # previews are served downsampled while the slider is dragged
+    factor = downsample_factor_from_args(request.args, slices[slice_index]['rows'], slices[slice_index]['columns'])
+    encoder = encoder_from_args(request.args, preview=factor > 1)
+    key = slice_key(index, version, slice_index, window, factor, encoder)
+    response = not_modified(key, version)
+    if response is None:
+        data = rendered_slice(index, version, slices, slice_index, window, factor, encoder)
+        response = cache_headers(Response(data, mimetype=encoder.mimetype), key, version)
+
+    # render the neighbours the slider is most likely to ask for next
+    prefetcher.focus((index.dicom_dir, window, factor, encoder.name), slice_index, len(slices),
+                     lambda neighbour: rendered_slice(index, version, slices, neighbour, window, factor, encoder))
+
+    return response
+
+# Multiplanar reconstruction API: an axial, coronal or sagittal plane of the series
+@app.route("/view_ct_mpr/<orientation>/<int:position>")
+def view_ct_mpr(orientation, position):
+    if orientation not in MPR_ORIENTATIONS:
+        abort(404)
+    index = series_index_from_args(request.args)
+    version, slices = index.snapshot()
+    if not slices:
+        abort(404)
+
+    # number of planes along each orientation
+    limits = {'axial': len(slices), 'coronal': slices[0]['rows'], 'sagittal': slices[0]['columns']}
+    if position < 0 or position >= limits[orientation]:
+        abort(404)
+
+    window = window_from_args(request.args)
+    factor = downsample_factor_from_args(request.args, slices[0]['rows'], slices[0]['columns'])
+    encoder = encoder_from_args(request.args, preview=factor > 1)
+    key = render_key(index.dicom_dir, version, 'mpr', orientation, position, window, factor, encoder.key)
+
+    def render():
+        plane = reslice(volume_cache.get_volume(index), orientation, position, series_geometry(slices))
+        center, width = display_window(window, index, slices[0], plane)
+        return encoder.encode(render_slice(downsample(plane, factor), center, width))
+
+    return image_response(key, version, render, encoder)
+
+# Intensity projection API: maximum (mip), minimum (minip) or mean intensity through the series
+@app.route("/view_ct_projection/<kind>")
+def view_ct_projection(kind):
+    if kind not in PROJECTIONS:
+        abort(404)
+    index = series_index_from_args(request.args)
+    _, slices = index.snapshot()
+    if not slices:
+        abort(404)
+    factor = downsample_factor_from_args(request.args, slices[0]['rows'], slices[0]['columns'])
+    encoder = encoder_from_args(request.args, preview=factor > 1)
+    return projection_response(index, kind, window_from_args(request.args), factor, encoder)
+
+# Series thumbnail API: a small projection image of the series
+@app.route("/view_ct_thumbnail")
+def view_ct_thumbnail():
+    index = series_index_from_args(request.args)
+    encoder = encoder_from_args(request.args, preview=True)
+    return projection_response(index, app.config['THUMBNAIL_PROJECTION'], None, thumbnail_factor(index), encoder)
+
+# Intensity statistics API: histogram, percentiles and auto window of a series
+@app.route("/view_ct_stats")
+def view_ct_stats():
+    index = series_index_from_args(request.args)
+    version, slices = index.snapshot()
+    if not slices:
+        abort(404)
+    etag = render_key(index.dicom_dir, version, 'statistics')
+    cached = not_modified(etag, version)
+    if cached is not None:
+        return cached
+
+    stats = volume_store.statistics(index, lambda: volume_cache.get_volume(index))
+    # server paths stay private
+    return cache_headers(jsonify({key: value for key, value in stats.items() if key != 'dicom_dir'}), etag, version)
+
+# Size of the raw int16 volume of a series
+def raw_volume_bytes(slices):
+    return len(slices) * slices[0]['rows'] * slices[0]['columns'] * 2 if slices else 0
+
+# Raw int16 pixels of one slice (or a slice stack) with their geometry in response headers,
+# the viewer does window/level itself so changing the window costs no server round trip.
+# deflated(), when given, returns the path of the pixels already compressed
+def raw_response(index, version, slices, selection, load, deflated=None):
+    compress = request.args.get('compress', 0, type=int) == 1
+    etag = render_key(index.dicom_dir, version, 'raw', selection, compress)
+    cached = not_modified(etag, version)
+    if cached is not None:
+        return cached
+
+    array = load()
+    geometry = series_geometry(slices)
+    headers = {
+        'X-Dtype': 'int16',
+        'X-Byte-Order': 'little',
+        'X-Shape': ','.join(str(n) for n in array.shape),
+        'X-Series-Version': version,
+        # pixels are already rescaled to output units (HU for CT)
+        'X-Rescale-Slope': '1',
+        'X-Rescale-Intercept': '0',
+        'X-Pixel-Spacing': ','.join(str(v) for v in geometry['pixel_spacing']),
+        'X-Slice-Spacing': str(geometry['slice_spacing']),
+        'X-Slice-Thickness': str(geometry['slice_thickness'] or ''),
+        'X-Window-Center': str(slices[0].get('window_center') or ''),
+        'X-Window-Width': str(slices[0].get('window_width') or ''),
+    }
+    if compress:
+        # "deflate" is the zlib format, browsers inflate it before handing over the ArrayBuffer
+        headers['Content-Encoding'] = 'deflate'
+    if compress and deflated is not None:
+        path = deflated()
+        headers['Content-Length'] = str(os.path.getsize(path))
+        body = wrap_file(request.environ, open(path, 'rb'))
+    else:
+        if not compress:
+            headers['Content-Length'] = str(array.size * 2)
+        body = iter_raw(array, compress=compress)
+    response = Response(body, mimetype='application/octet-stream', headers=headers, direct_passthrough=True)
+    return cache_headers(response, etag, version)
+
+# Raw slice API
+@app.route("/view_ct_raw/<int:slice_index>")
+def view_ct_raw(slice_index):
+    index = series_index_from_args(request.args)
+    version, slices = index.snapshot()
+    if slice_index < 0 or slice_index >= len(slices):
+        abort(404)
+    return raw_response(index, version, slices, slice_index, lambda: volume_cache.get_slice(index, slice_index))
+
+# Raw volume API, every slice of the series in index order. Volumes above RAW_VOLUME_MAX_BYTES are
+# refused, and the compressed volume is written to the volume store once instead of per request
+@app.route("/view_ct_raw/volume")
+def view_ct_raw_volume():
+    index = series_index_from_args(request.args)
+    version, slices = index.snapshot()
+    if not slices:
+        abort(404)
+    if raw_volume_bytes(slices) > app.config['RAW_VOLUME_MAX_BYTES']:
+        abort(400)
+    return raw_response(index, version, slices, 'volume', lambda: volume_cache.get_volume(index),
+                        lambda: volume_store.deflated(index, lambda: volume_cache.get_volume(index)))
+
+# Sprite atlas API: a contiguous range of slices [start, stop) tiled into a single PNG
+@app.route("/view_ct_atlas/<int:start>/<int:stop>")
+def view_ct_atlas(start, stop):
+    index = series_index_from_args(request.args)
+    version, slices = index.snapshot()
+    slice_range(slices, start, stop)
+    window = window_from_args(request.args)
+    encoder = encoder_from_args(request.args)
+    columns = atlas_columns(stop - start)
+    atlas_size = columns * max(slices[start]['rows'], slices[start]['columns'])
+    if atlas_size > encoder.max_dimension:
+        encoder = encoders['png']
+    key = render_key(index.dicom_dir, version, 'atlas', start, stop, window, None, encoder.key)
+
+    def render():
+        hu_slices = volume_cache.get_volume(index)[start:stop]
+        center, width = display_window(window, index, slices[start], hu_slices[0])
+        return encoder.encode(render_atlas(hu_slices, center, width, columns))
+
+    return image_response(key, version, render, encoder)
+
+# JSON manifest describing where each slice of an atlas is located
+@app.route("/view_ct_atlas/<int:start>/<int:stop>/manifest")
+def view_ct_atlas_manifest(start, stop):
+    index = series_index_from_args(request.args)
+    version, slices = index.snapshot()
+    slice_range(slices, start, stop)
+    columns = atlas_columns(stop - start)
+    tile_width, tile_height = slices[start]['columns'], slices[start]['rows']
+    etag = render_key(index.dicom_dir, version, 'manifest', start, stop, sorted(request.args.items()))
+    cached = not_modified(etag, version)
+    if cached is not None:
+        return cached
+
+    return cache_headers(jsonify({
+        'atlas': url_for('view_ct_atlas', start=start, stop=stop, **request.args),
+        'version': version,
+        'tile_width': tile_width,
+        'tile_height': tile_height,
+        'columns': columns,
+        'slices': [
+            {'index': i, 'x': (i - start) % columns * tile_width, 'y': (i - start) // columns * tile_height}
+            for i in range(start, stop)
+        ],
+    }), etag, version)
+
+# Multipart API: a contiguous range of slices [start, stop) streamed as one multipart/mixed response
+@app.route("/view_ct_slices/<int:start>/<int:stop>")
+def view_ct_slices(start, stop):
+    index = series_index_from_args(request.args)
+    version, slices = index.snapshot()
+    slice_indices = slice_range(slices, start, stop)
+    window = window_from_args(request.args)
+    encoder = encoder_from_args(request.args)
+    boundary = uuid.uuid4().hex
+
+    def generate():
+        for slice_index in slice_indices:
+            data = rendered_slice(index, version, slices, slice_index, window, 1, encoder)
+            yield (f"--{boundary}\r\nContent-Type: {encoder.mimetype}\r\nContent-Length: {len(data)}\r\n"
+                   f"X-Slice-Index: {slice_index}\r\n\r\n").encode()
+            yield data
+            yield b"\r\n"
+        yield f"--{boundary}--\r\n".encode()
+
+    return Response(generate(), mimetype=f"multipart/mixed; boundary={boundary}")
+
+# Cine playback API: slices [start, stop) streamed at "fps" frames per second over one long-lived
+# connection, as multipart/x-mixed-replace (an <img> plays it directly) or with "stream=sse" as
+# Server-Sent Events carrying the slice index and a data URL of each frame
+@app.route("/view_ct_cine")
+def view_ct_cine():
+    index = series_index_from_args(request.args)
+    version, slices = index.snapshot()
+    if not slices:
+        abort(404)
+    start = request.args.get('start', 0, type=int)
+    stop = request.args.get('stop', len(slices), type=int)
+    if start < 0 or stop > len(slices) or start >= stop:
+        abort(400)
+    fps = request.args.get('fps', app.config['CINE_FPS'], type=float)
+    loops = request.args.get('loops', 1, type=int)
+    if not app.config['CINE_MIN_FPS'] <= fps <= app.config['CINE_MAX_FPS'] or not 0 < loops <= app.config['CINE_MAX_LOOPS']:
+        abort(400)
+    stream = request.args.get('stream', 'multipart')
+    if stream not in ('multipart', 'sse'):
+        abort(400)
+
+    window = window_from_args(request.args)
+    factor = downsample_factor_from_args(request.args, slices[0]['rows'], slices[0]['columns'])
+    encoder = encoder_from_args(request.args, preview=factor > 1)
+    boundary = uuid.uuid4().hex
+    # every stream has its own prefetch focus, two viewers playing the same series do not cancel
+    # each other's prefetched frames
+    focus_key = (index.dicom_dir, window, factor, encoder.name, 'cine', uuid.uuid4().hex)
+
+    def render(slice_index):
+        return rendered_slice(index, version, slices, slice_index, window, factor, encoder)
+
+    # load the series before the playback clock starts, so opening it does not drop the first frames
+    render(start)
+
+    def frames():
+        # the WSGI server advances this generator only once the previous frame was written,
+        # slices ahead of the playback position are rendered by the prefetcher meanwhile
+        try:
+            for slice_index in paced(cine_frames(start, stop, loops), fps, app.config['CINE_MAX_SECONDS']):
+                prefetcher.focus(focus_key, slice_index, stop, render)
+                yield slice_index, render(slice_index)
+        finally:
+            prefetcher.forget(focus_key)
+
+    def multipart():
+        for slice_index, data in frames():
+            yield (f"--{boundary}\r\nContent-Type: {encoder.mimetype}\r\nContent-Length: {len(data)}\r\n"
+                   f"X-Slice-Index: {slice_index}\r\n\r\n").encode()
+            yield data
+            yield b"\r\n"
+        yield f"--{boundary}--\r\n".encode()
+
+    def events():
+        for slice_index, data in frames():
+            image = f"data:{encoder.mimetype};base64,{base64.b64encode(data).decode()}"
+            yield f"id: {slice_index}\nevent: frame\ndata: {json.dumps({'index': slice_index, 'image': image})}\n\n"
+        # EventSource reconnects when a stream simply ends, tell the client to close it
+        yield "event: end\ndata: {}\n\n"
+
+    # proxies must pass frames through as they are written
+    headers = {'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'}
+    if stream == 'sse':
+        return Response(events(), mimetype='text/event-stream', headers=headers)
+    return Response(multipart(), mimetype=f"multipart/x-mixed-replace; boundary={boundary}", headers=headers)
@@ -0,0 +1,210 @@
+# File: search.py
+#
+# Description: In-process trigram index for patient search. Names and diagnoses are split
+#              into words, every word into trigrams (padded at the word start so one and
+#              two letter queries work as prefixes), and each trigram maps to the set of
+#              patients containing it. A query intersects the posting sets of its trigrams
+#              and the top results are taken in name order, so lookups do not depend on the
+#              number of patients. The index is kept current by the write routes and rebuilt
+#              from the database periodically to pick up writes made by other worker processes.
+
+import bisect
+import logging
+import re
+import threading
+import time
+import unicodedata
+
+logger = logging.getLogger(__name__)
+
+WORD_PATTERN = re.compile(r"\w+")
+
+# posting sets up to this size are intersected and sorted; a query whose rarest trigram is
+# more common than that matches a large share of patients, and walking the name order finds
+# the first results sooner than building the intersection
+SCAN_THRESHOLD = 2048
+
+
+def normalize(text):
+    """Lower-case text without accents, so "José" is found by "jose"."""
+    text = text or ""
+    if not text.isascii():
+        decomposed = unicodedata.normalize("NFKD", text)
+        text = "".join(c for c in decomposed if not unicodedata.combining(c))
+    return text.casefold()
+
+
+def words(text):
+    return WORD_PATTERN.findall(normalize(text))
+
+
+def word_trigrams(word):
+    """Trigrams of a word, including the two start-padded prefix trigrams ("  a", " ab")."""
+    padded = "  " + word
+    return {padded[i:i + 3] for i in range(len(padded) - 2)}
+
+
+def query_trigrams(term):
+    """
+    Trigrams every word matching term contains: the padded prefix trigram for
+    terms shorter than three letters (matched as word prefixes), the inner
+    trigrams otherwise (matched anywhere in a word).
+    """
+    if len(term) < 3:
+        return {("  " + term)[-3:]}
+    return {term[i:i + 3] for i in range(len(term) - 2)}
+
+
+class PatientSearchIndex:
+    """
+    Trigram index over patient names and diagnoses. load() returns every
+    (id, name, diagnosis) row; it is used by build() and by the rebuilds every
+    max_age seconds, which run in a background thread while searches keep using
+    the previous index. After a failed build no other is started for
+    retry_interval seconds.
+    """
+
+    def __init__(self, load, max_age, retry_interval=30):
+        self.load = load
+        self.max_age = max_age
+        self.retry_interval = retry_interval
+        # id -> (sort key, id, name, diagnosis, words, trigrams)
+        self._documents = {}
+        self._postings = {}
+        # sort keys of every patient in name order
+        self._order = []
+        self._built_at = None
+        self._failed_at = None
+        self._rebuilding = False
+        self._lock = threading.Lock()
+        self._build_lock = threading.Lock()
+
+    def build_in_background(self):
+        """Start the initial build without blocking the caller, unless it already ran or is running."""
+        if self._built_at is None and not self._rebuilding and not self._backing_off():
+            self._start_rebuild()
+
+    def search(self, query, limit=10):
+        """Patients whose name or diagnosis words contain every word of query, as (id, name, diagnosis) in name order."""
+        self._ensure_fresh()
+        terms = words(query)
+        if not terms:
+            return []
+        grams = set().union(*(query_trigrams(term) for term in terms))
+        # a term made of a single trigram matches exactly the words holding it
+        verify = any(len(term) > 3 for term in terms)
+
+        with self._lock:
+            postings = sorted((self._postings.get(gram, set()) for gram in grams), key=len)
+            if len(postings[0]) <= SCAN_THRESHOLD:
+                candidates = postings[0].intersection(*postings[1:])
+                ranked = sorted(self._documents[patient_id] for patient_id in candidates)
+            else:
+                ranked = (self._documents[key[-1]] for key in self._order
+                          if all(key[-1] in posting for posting in postings))
+
+            results = []
+            for document in ranked:
+                if verify and not all(self._matches(term, document) for term in terms):
+                    continue
+                results.append(document[1:4])
+                if len(results) == limit:
+                    break
+        return results
+
+    def add(self, patient_id, name, diagnosis):
+        """Index a new patient or re-index an edited one."""
+        document = self._document(patient_id, name, diagnosis)
+        with self._lock:
+            self._remove(patient_id)
+            self._documents[patient_id] = document
+            for gram in document[5]:
+                self._postings.setdefault(gram, set()).add(patient_id)
+            bisect.insort(self._order, document[0])
+
+    def remove(self, patient_id):
+        with self._lock:
+            self._remove(patient_id)
+
+    def rebuild(self):
+        """Build a new index from load() and swap it in."""
+        documents, postings = {}, {}
+        for patient_id, name, diagnosis in self.load():
+            document = self._document(patient_id, name, diagnosis)
+            documents[patient_id] = document
+            for gram in document[5]:
+                posting = postings.get(gram)
+                if posting is None:
+                    postings[gram] = posting = set()
+                posting.add(patient_id)
+        order = sorted(document[0] for document in documents.values())
+        with self._lock:
+            self._documents, self._postings, self._order = documents, postings, order
+            self._built_at = time.monotonic()
+            self._failed_at = None
+        logger.info("patient search index rebuilt with %d patients", len(documents))
+
+    def _ensure_fresh(self):
+        if self._backing_off():
+            # searches use whatever index there is until the next try
+            return
+        if self._built_at is None:
+            # the first searches wait for the initial build
+            with self._build_lock:
+                if self._built_at is None:
+                    self._rebuild_logged()
+        elif time.monotonic() - self._built_at > self.max_age:
+            self._start_rebuild()
+
+    def _backing_off(self):
+        return self._failed_at is not None and time.monotonic() - self._failed_at < self.retry_interval
+
+    def _rebuild_logged(self):
+        try:
+            self.rebuild()
+        except Exception:
+            self._failed_at = time.monotonic()
+            logger.exception("patient search index rebuild failed")
+
+    def _start_rebuild(self):
+        with self._lock:
+            if self._rebuilding:
+                return
+            self._rebuilding = True
+        threading.Thread(target=self._rebuild_in_background, name="search-index", daemon=True).start()
+
+    def _rebuild_in_background(self):
+        try:
+            with self._build_lock:
+                self._rebuild_logged()
+        finally:
+            self._rebuilding = False
+
+    @staticmethod
+    def _document(patient_id, name, diagnosis):
+        name_words, diagnosis_words = words(name), words(diagnosis)
+        grams = set()
+        for word in name_words + diagnosis_words:
+            grams |= word_trigrams(word)
+        # documents sort by normalized name, then id
+        return (" ".join(name_words), patient_id), patient_id, name, diagnosis, name_words + diagnosis_words, grams
+
+    @staticmethod
+    def _matches(term, document):
+        if len(term) < 3:
+            return any(word.startswith(term) for word in document[4])
+        return any(term in word for word in document[4])
+
+    def _remove(self, patient_id):
+        document = self._documents.pop(patient_id, None)
+        if document is None:
+            return
+        for gram in document[5]:
+            posting = self._postings.get(gram)
+            if posting is not None:
+                posting.discard(patient_id)
+                if not posting:
+                    del self._postings[gram]
+        position = bisect.bisect_left(self._order, document[0])
+        if position < len(self._order) and self._order[position] == document[0]:
+            del self._order[position]
@@ -0,0 +1,170 @@
+# File: volume_store.py
+#
+# Description: On-disk store of preprocessed CT volumes. Each series is written once as
+#              an int16 .npy file plus a JSON metadata sidecar; requests open the .npy
+#              with np.load(mmap_mode='r') so every worker process shares the same OS page
+#              cache and nothing is decoded on the request path once a series is ingested.
+#              Intensity projections of each series are stored the same way, and its
+#              intensity histogram and percentiles in a JSON file kept in memory once read.
+#              The deflate-compressed raw volume served to the viewer is written once too.
+
+import hashlib
+import json
+import os
+import tempfile
+
+import numpy as np
+
+from app.dicom_cache import decode_volume
+from app.dicom_index import series_geometry
+from app.imaging import PROJECTIONS, compute_projections, iter_raw, volume_statistics
+
+
+class VolumeStore:
+    """
+    Arrays derived from a series, stored per kind: "volume" is the full int16
+    volume, "projections" the stacked MIP / MinIP / mean projections. The
+    "statistics" kind only has its JSON file.
+    """
+
+    def __init__(self, store_dir):
+        self.store_dir = store_dir
+        # statistics read or computed so far, by series folder
+        self._statistics = {}
+
+    def paths(self, index, kind="volume"):
+        """Return the (.npy, .json) paths of one kind of array of a series."""
+        return self._paths(index.dicom_dir, kind)
+
+    def _paths(self, dicom_dir, kind):
+        name = hashlib.sha1(dicom_dir.encode()).hexdigest()[:16]
+        base = os.path.join(self.store_dir, name if kind == "volume" else f"{name}.{kind}")
+        return base + ".npy", base + ".json"
+
+    def metadata(self, index, kind="volume"):
+        """Sidecar metadata of a stored array, or None if it was never written."""
+        return self._metadata(index.dicom_dir, kind)
+
+    def stored_version(self, dicom_dir, kind="volume"):
+        """
+        Series version an array of a series folder was last stored for, or None.
+        Only the sidecar is read, the folder and its series index are not touched.
+        """
+        meta = self._metadata(os.path.abspath(dicom_dir), kind)
+        return None if meta is None else meta["version"]
+
+    def _metadata(self, dicom_dir, kind):
+        _, meta_path = self._paths(dicom_dir, kind)
+        try:
+            with open(meta_path) as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return None
+
+    def load(self, index, version, kind="volume"):
+        """Memory-map the stored array if it matches the series version, else return None."""
+        array_path, _ = self.paths(index, kind)
+        meta = self.metadata(index, kind)
+        if meta is None or meta["version"] != version:
+            return None
+        try:
+            return np.load(array_path, mmap_mode="r")
+        except (OSError, ValueError):
+            return None
+
+    def save(self, index, version, slices, array, kind="volume"):
+        array_path, meta_path = self.paths(index, kind)
+        os.makedirs(self.store_dir, exist_ok=True)
+
+        meta = {
+            "version": version,
+            "dicom_dir": index.dicom_dir,
+            "shape": list(array.shape),
+            "dtype": str(array.dtype),
+            "filenames": [entry["filename"] for entry in slices],
+            **series_geometry(slices),
+        }
+        if kind == "projections":
+            meta["projections"] = list(PROJECTIONS)
+        # the array is renamed into place before its sidecar, so a sidecar never
+        # points at a partially written array
+        atomic_write(array_path, lambda f: np.save(f, array), suffix=".npy")
+        atomic_write(meta_path, lambda f: f.write(json.dumps(meta).encode()), suffix=".json")
+
+    def ingest(self, index):
+        """
+        Decode a series into the store unless it is already up to date, compute its
+        projections, and return the mapped volume.
+        """
+        version, slices = index.snapshot()
+        volume = self.load(index, version)
+        if volume is None:
+            self.save(index, version, slices, decode_volume(index.dicom_dir, slices))
+            volume = self.load(index, version)
+        self.projections(index, lambda: volume)
+        self.statistics(index, lambda: volume)
+        return volume
+
+    def projections(self, index, load_volume):
+        """
+        Stacked (MIP, MinIP, mean) projections of a series, computed from
+        load_volume() on first use and read back from the store afterwards.
+        """
+        version, slices = index.snapshot()
+        stack = self.load(index, version, "projections")
+        if stack is None:
+            self.save(index, version, slices, compute_projections(load_volume()), "projections")
+            stack = self.load(index, version, "projections")
+        return stack
+
+    def deflated(self, index, load_volume):
+        """
+        Path of the volume of a series as a zlib (deflate) stream of little-endian
+        int16, compressed from load_volume() on first use and read back afterwards.
+        """
+        version, _ = index.snapshot()
+        array_path, meta_path = self.paths(index, "deflate")
+        data_path = os.path.splitext(array_path)[0] + ".zz"
+        meta = self.metadata(index, "deflate")
+        if meta is None or meta["version"] != version or not os.path.exists(data_path):
+            os.makedirs(self.store_dir, exist_ok=True)
+            meta = {"version": version, "dicom_dir": index.dicom_dir}
+            # the data is renamed into place before its sidecar, as in save()
+            atomic_write(data_path, lambda f: f.writelines(iter_raw(load_volume(), compress=True)), suffix=".zz")
+            atomic_write(meta_path, lambda f: f.write(json.dumps(meta).encode()), suffix=".json")
+        return data_path
+
+    def statistics(self, index, load_volume=None):
+        """
+        Intensity statistics of a series (see imaging.volume_statistics). Served from
+        memory after the first read; computed from load_volume() when they are not
+        stored yet, or None when no load_volume is given.
+        """
+        version, _ = index.snapshot()
+        stats = self._statistics.get(index.dicom_dir)
+        if stats is not None and stats["version"] == version:
+            return stats
+
+        stats = self.metadata(index, "statistics")
+        if stats is None or stats["version"] != version:
+            if load_volume is None:
+                return None
+            stats = dict(volume_statistics(load_volume()), version=version, dicom_dir=index.dicom_dir)
+            _, meta_path = self.paths(index, "statistics")
+            os.makedirs(self.store_dir, exist_ok=True)
+            atomic_write(meta_path, lambda f: f.write(json.dumps(stats).encode()), suffix=".json")
+        self._statistics[index.dicom_dir] = stats
+        return stats
+
+
+def atomic_write(path, write, suffix=""):
+    """Write a file through a temporary file in the same folder and rename it into place."""
+    fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path), suffix=suffix + ".tmp")
+    try:
+        with os.fdopen(fd, "wb") as f:
+            write(f)
+        os.replace(tmp_path, path)
+    except BaseException:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        raise
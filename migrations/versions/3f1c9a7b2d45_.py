@@ -0,0 +1,26 @@
+"""link medical images to ingested DICOM series
+
+Revision ID: 3f1c9a7b2d45
+Revises: 
+Create Date: 2026-10-17 10:12:31.402118
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '3f1c9a7b2d45'
+down_revision = None
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    with op.batch_alter_table('MedicalImage', schema=None) as batch_op:
+        batch_op.add_column(sa.Column('series_uid', sa.String(length=64), nullable=True))
+
+
+def downgrade():
+    with op.batch_alter_table('MedicalImage', schema=None) as batch_op:
+        batch_op.drop_column('series_uid')
@@ -0,0 +1,32 @@
+"""index the patient list sort and filter columns
+
+Revision ID: 8b2e4d6f1a93
+Revises: 3f1c9a7b2d45
+Create Date: 2026-10-17 14:05:48.219604
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '8b2e4d6f1a93'
+down_revision = '3f1c9a7b2d45'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    with op.batch_alter_table('Patient', schema=None) as batch_op:
+        batch_op.create_index('ix_patient_name', ['name'], unique=False)
+        batch_op.create_index('ix_patient_date_of_birth', ['date_of_birth'], unique=False)
+        batch_op.create_index('ix_patient_diagnosis_name', ['diagnosis', 'name'], unique=False)
+        batch_op.create_index('ix_patient_diagnosis_date_of_birth', ['diagnosis', 'date_of_birth'], unique=False)
+
+
+def downgrade():
+    with op.batch_alter_table('Patient', schema=None) as batch_op:
+        batch_op.drop_index('ix_patient_diagnosis_date_of_birth')
+        batch_op.drop_index('ix_patient_diagnosis_name')
+        batch_op.drop_index('ix_patient_date_of_birth')
+        batch_op.drop_index('ix_patient_name')